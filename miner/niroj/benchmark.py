@@ -0,0 +1,298 @@
+import hashlib
+import os
+import struct
+import sys
+import time
+import block_model
+import cpu_search
+import merkle
+import midstate
+import ntgbtminer
+import sha256_download
+import sha256_unrolled
+import work_queue
+
+'''
+Timings of the PC side of the miner. Run with
+    $python benchmark.py [count]
+'''
+
+def report(name, count, elapsed):
+    print '%-36s %10d in %0.2f secs (%0.2f /s)' % (name, count, elapsed, float(count) / elapsed)
+
+# The per nonce loop block_mine used before cpu_search: rebuild the 80 byte
+# header by string concatenation and hash it twice
+def header_rehash_loop(header, target_hash, count):
+    for nonce in xrange(count):
+        header = header[0:76] + chr(nonce & 0xff) + chr((nonce >> 8) & 0xff) + chr((nonce >> 16) & 0xff) + chr((nonce >> 24) & 0xff)
+        if hashlib.sha256(hashlib.sha256(header).digest()).digest()[::-1] <= target_hash:
+            return nonce
+    return None
+
+def bench_cpu_engines(count):
+    header = os.urandom(76)
+    # Nothing meets the target, every nonce is hashed
+    target_hash = "\x00"*32
+
+    start = time.time()
+    header_rehash_loop(header, target_hash, count)
+    report('header rehash (old loop)', count, time.time() - start)
+
+    for engine in sorted(cpu_search.ENGINES):
+        # The pure Python engine is two orders of magnitude slower
+        engine_count = count // 100 if engine == "python" else count
+        start = time.time()
+        cpu_search.search_nonce(header, target_hash, 0, engine_count - 1, engine)
+        report('cpu_search engine=' + engine, engine_count, time.time() - start)
+
+# Second header chunk: full calculateMidstate() per nonce against the
+# MidstateJob resumed from round 3
+def bench_midstate_job(count):
+    header = os.urandom(76)
+    state = midstate.calculateMidstate(header[0:64])
+    padding = "\x80" + "\x00"*45 + "\x02\x80"
+
+    start = time.time()
+    for nonce in xrange(count):
+        midstate.calculateMidstate(header[64:76] + struct.pack("<L", nonce) + padding, state, 64)
+    report('calculateMidstate', count, time.time() - start)
+
+    start = time.time()
+    job = midstate.MidstateJob(header[64:76], state)
+    for nonce in xrange(count):
+        midstate.calculateNonceMidstate(job, nonce)
+    report('calculateNonceMidstate', count, time.time() - start)
+
+# One 64 byte block through the clarity oriented sha256_download.SHA256
+# against the generated straight-line compression
+def bench_compress(count):
+    block = os.urandom(64)
+    words = struct.unpack('>16I', block)
+
+    start = time.time()
+    for i in xrange(count):
+        sha256_download.SHA256._process_block(block)
+    report('SHA256._process_block', count, time.time() - start)
+
+    start = time.time()
+    for i in xrange(count):
+        sha256_unrolled.compress(sha256_unrolled.IV, words)
+    report('sha256_unrolled.compress', count, time.time() - start)
+
+# Synthetic getblocktemplate result with tx_count transactions of tx_size bytes
+def synthetic_template(tx_count, tx_size=250):
+    transactions = []
+    for i in xrange(tx_count):
+        data = struct.pack("<L", i) + "\xab"*(tx_size - 4)
+        transactions.append({'data': ntgbtminer.bin2hex(data), 'hash': ntgbtminer.bin2hex(block_model.txid(data)[::-1])})
+    return {
+        'version': 0x20000000,
+        'previousblockhash': "00"*32,
+        'curtime': 1296688602,
+        'bits': "1d00ffff",
+        'coinbasevalue': 5000000000,
+        'transactions': transactions,
+    }
+
+# hex2bin as it was before binascii, one character at a time
+def quadratic_hex2bin(s):
+    b = ""
+    for i in range(len(s)/2):
+        b += chr(int(s[2*i : 2*i + 2], 16))
+    return b
+
+# Decode size bytes of hex with the old hex2bin and with binascii
+def bench_hex2bin(size):
+    data = ntgbtminer.bin2hex(os.urandom(size))
+
+    start = time.time()
+    quadratic_hex2bin(data)
+    report('hex2bin char by char %dB' % size, 1, time.time() - start)
+
+    start = time.time()
+    ntgbtminer.hex2bin(data)
+    report('hex2bin binascii %dB' % size, 1, time.time() - start)
+
+# Template to first header and one extranonce roll: the hex pipeline of
+# ntgbtminer against the binary block_model
+def bench_first_header(tx_count, address="15PKyTs3jJ3Nyf3i6R7D9tfGCY1ZbtqWdv"):
+    template = synthetic_template(tx_count)
+    template['nonce'] = 0
+
+    start = time.time()
+    for extranonce in (0, 1):
+        coinbase_hex = ntgbtminer.tx_make_coinbase("00" + ntgbtminer.int2lehex(extranonce, 4), address, template['coinbasevalue'])
+        tx_hashes = [ntgbtminer.tx_compute_hash(coinbase_hex)] + [tx['hash'] for tx in template['transactions']]
+        template['merkleroot'] = ntgbtminer.tx_compute_merkle_root(tx_hashes)
+        ntgbtminer.block_form_header(template)
+        report('hex header %d %d txs' % (extranonce, tx_count), 1, time.time() - start)
+        start = time.time()
+
+    start = time.time()
+    model = block_model.BlockTemplate.from_rpc(template)
+    for extranonce in (0, 1):
+        coinbase = model.coinbase("\x00" + struct.pack("<L", extranonce), address)
+        model.header(model.merkle_root(block_model.txid(coinbase)))
+        report('binary header %d %d txs' % (extranonce, tx_count), 1, time.time() - start)
+        start = time.time()
+
+# tx_compute_merkle_root as it was before block_model.merkle_root: hex
+# decoding in place and two list.pop(0) per node
+def pop_merkle_root(tx_hashes):
+    for i in range(len(tx_hashes)):
+        tx_hashes[i] = ntgbtminer.hex2bin(tx_hashes[i])[::-1]
+    while len(tx_hashes) > 1:
+        if len(tx_hashes) % 2 != 0:
+            tx_hashes.append(tx_hashes[-1][:])
+        tx_hashes_new = []
+        for i in range(len(tx_hashes)/2):
+            concat = tx_hashes.pop(0) + tx_hashes.pop(0)
+            tx_hashes_new.append(hashlib.sha256(hashlib.sha256(concat).digest()).digest())
+        tx_hashes = tx_hashes_new
+    return ntgbtminer.bin2hex(tx_hashes[0][::-1])
+
+# Merkle root of tx_count synthetic txids: the old pop(0) loop against the
+# level-array builder, from hex and from binary txids
+def bench_merkle_root(tx_count):
+    txids = [block_model.txid(struct.pack("<L", i)) for i in xrange(tx_count)]
+    tx_hashes = [ntgbtminer.bin2hex(txid[::-1]) for txid in txids]
+
+    start = time.time()
+    pop_merkle_root(list(tx_hashes))
+    report('pop(0) merkle root %d txs' % tx_count, 1, time.time() - start)
+
+    start = time.time()
+    ntgbtminer.tx_compute_merkle_root(tx_hashes)
+    report('tx_compute_merkle_root %d txs' % tx_count, 1, time.time() - start)
+
+    start = time.time()
+    block_model.merkle_root(txids)
+    report('block_model.merkle_root %d txs' % tx_count, 1, time.time() - start)
+
+# txids of tx_count transactions of tx_size bytes, inline against
+# block_model.compute_tx_hashes() (thread pool for the large ones)
+def bench_tx_hashes(tx_count, tx_size):
+    datas = [struct.pack("<L", i) + "\xab"*(tx_size - 4) for i in xrange(tx_count)]
+
+    start = time.time()
+    [block_model.tx_hashes(data) for data in datas]
+    report('tx_hashes inline %dx%dB' % (tx_count, tx_size), tx_count, time.time() - start)
+
+    start = time.time()
+    block_model.compute_tx_hashes(datas)
+    report('compute_tx_hashes %dx%dB' % (tx_count, tx_size), tx_count, time.time() - start)
+
+# Coinbase txid per extranonce: hex tx_make_coinbase + tx_compute_hash,
+# binary make_coinbase + txid and the compiled block_model.CoinbaseTemplate
+def bench_coinbase(count, address="15PKyTs3jJ3Nyf3i6R7D9tfGCY1ZbtqWdv"):
+    message = "Hello from vsergeev!"
+    value = 5000000000
+
+    start = time.time()
+    for extranonce in xrange(count):
+        coinbase_hex = ntgbtminer.tx_make_coinbase(ntgbtminer.bin2hex(message) + ntgbtminer.int2lehex(extranonce, 4), address, value)
+        ntgbtminer.tx_compute_hash(coinbase_hex)
+    report('hex coinbase txid', count, time.time() - start)
+
+    start = time.time()
+    for extranonce in xrange(count):
+        block_model.txid(block_model.make_coinbase(message + struct.pack("<L", extranonce), address, value))
+    report('make_coinbase txid', count, time.time() - start)
+
+    coinbase_template = block_model.CoinbaseTemplate(message, address, value)
+    start = time.time()
+    for extranonce in xrange(count):
+        coinbase_template.txid(extranonce)
+    report('CoinbaseTemplate.txid', count, time.time() - start)
+
+# Next template with 1% of the transactions replaced at the end and 1% added:
+# full branch rebuild against merkle.MerkleTree.update()
+def bench_merkle_update(tx_count):
+    txids = [block_model.txid(struct.pack("<L", i)) for i in xrange(tx_count)]
+    changed = tx_count // 100
+    next_txids = txids[0:tx_count - changed] + [block_model.txid(struct.pack("<Q", i)) for i in xrange(2*changed)]
+
+    start = time.time()
+    block_model.merkle_branch(next_txids)
+    report('merkle_branch %d txs' % tx_count, 1, time.time() - start)
+
+    tree = merkle.MerkleTree(txids)
+    start = time.time()
+    tree.update(next_txids)
+    report('MerkleTree.update %d txs' % tx_count, 1, time.time() - start)
+
+# Host work per new header: an extranonce roll (coinbase txid, Merkle branch
+# fold, new midstate), a BIP320 version roll (new midstate only) and an ntime
+# roll on the same Merkle root, which only changes the second chunk and keeps
+# the midstate
+def bench_header_rolls(tx_count, count, address="15PKyTs3jJ3Nyf3i6R7D9tfGCY1ZbtqWdv"):
+    template = block_model.BlockTemplate.from_rpc(synthetic_template(tx_count))
+    coinbase_template = template.coinbase_template("\x00", address)
+    template.merkle_branch()
+
+    start = time.time()
+    for extranonce in xrange(count):
+        header = template.header(template.merkle_root(coinbase_template.txid(extranonce)))
+        midstate.calculateMidstate(header[0:64])
+    report('extranonce roll %d txs' % tx_count, count, time.time() - start)
+
+    header = template.header(template.merkle_root(coinbase_template.txid(0)))
+    mask = template.version_mask()
+    start = time.time()
+    midstate.calculateVersionMidstates(header, [block_model.rolled_version(template.version, mask, n) for n in xrange(count)])
+    report('version roll (batched) %d txs' % tx_count, count, time.time() - start)
+
+    merkle_root = template.merkle_root(coinbase_template.txid(0))
+    start = time.time()
+    for ntime in xrange(template.curtime, template.curtime + count):
+        template.header(merkle_root, 0, ntime)[64:76]
+    report('ntime roll %d txs' % tx_count, count, time.time() - start)
+
+# Preparation latency seen by the miner for a template of tx_count
+# transactions: fetch and build a unit serially against pulling it from a
+# warmed up work_queue.WorkGenerator
+def bench_work_queue(tx_count, count=20, address="15PKyTs3jJ3Nyf3i6R7D9tfGCY1ZbtqWdv"):
+    rpc_template = synthetic_template(tx_count)
+
+    start = time.time()
+    for i in xrange(count):
+        template = block_model.BlockTemplate.from_rpc(rpc_template)
+        coinbase_template = template.coinbase_template("\x00", address)
+        header = template.header(template.merkle_root(coinbase_template.txid(0)))
+        work_queue.WorkUnit(template, coinbase_template, 0, header, 0)
+    report('serial unit %d txs' % tx_count, count, time.time() - start)
+
+    work = work_queue.WorkGenerator("\x00", address, lambda: rpc_template, poll_interval=3600).start()
+    work.get()
+    time.sleep(0.5)
+    elapsed = 0
+    for i in xrange(count):
+        start = time.time()
+        work.get()
+        elapsed += time.time() - start
+        # The miner would hash here, give the producer time to refill
+        time.sleep(0.01)
+    work.stop()
+    report('prefetched unit %d txs' % tx_count, count, elapsed)
+
+
+if __name__ == '__main__':
+    try:
+        count = int(sys.argv[1])
+    except (ValueError, IndexError):
+        count = 1000000 # default
+
+    bench_cpu_engines(count)
+    bench_midstate_job(count // 100)
+    bench_compress(count // 100)
+    bench_hex2bin(1000000)
+    bench_coinbase(count // 10)
+    for tx_count in (1, 1000, 10000):
+        bench_first_header(tx_count)
+        bench_merkle_update(tx_count)
+    for tx_count in (1, 1000, 10000, 100000):
+        bench_merkle_root(tx_count)
+    bench_tx_hashes(10000, 250)
+    bench_header_rolls(10000, count // 100)
+    bench_work_queue(10000)
+    bench_tx_hashes(1000, 50000)
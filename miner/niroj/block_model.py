@@ -0,0 +1,464 @@
+import atexit
+import binascii
+import hashlib
+import struct
+import threading
+from multiprocessing.pool import ThreadPool
+from config import TXID_THREADS, NTIME_ROLL_LIMIT, VERSION_ROLLING
+
+'''
+Binary block model. A getblocktemplate result is decoded once into byte
+strings and integers; transactions, hashes, the coinbase and the header are
+then built and hashed without any hex round trip. Hex is only produced again
+for the RPC (submitblock, the 'hash' / 'merkleroot' fields of a solved block).
+
+Hashes are kept in internal byte order (the order they are hashed and
+serialized in, i.e. reversed with respect to the RPC hex), targets in big
+endian like ntgbtminer.block_bits2target.
+'''
+
+# version, previous block hash, merkle root, time, bits, nonce
+HEADER_STRUCT = struct.Struct("<L32s32sLLL")
+
+# BIP320 general purpose version bits
+VERSION_ROLLING_MASK = 0x1fffe000
+# BIP9 top bits, version bits are only meaningful (and rolled) with 001
+VERSION_BITS_TOP_MASK = 0xe0000000
+VERSION_BITS_TOP = 0x20000000
+
+_u16_struct = struct.Struct("<H")
+_u32_struct = struct.Struct("<L")
+_u64_struct = struct.Struct("<Q")
+
+# Coinbase input: version, in-counter, null prevout (hash, index)
+COINBASE_PREFIX = "\x01\x00\x00\x00" + "\x01" + "\x00"*32 + "\xff\xff\xff\xff"
+
+_base58_table = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+_hash160_cache = {}
+
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+# Bitcoin varint of an unsigned integer
+def varint(x):
+    if x < 0xfd: return chr(x)
+    elif x <= 0xffff: return "\xfd" + _u16_struct.pack(x)
+    elif x <= 0xffffffff: return "\xfe" + _u32_struct.pack(x)
+    else: return "\xff" + _u64_struct.pack(x)
+
+# Hash-160 (20 bytes) of a Base58 Bitcoin address, decoded once per address
+def address_hash160(address):
+    if address not in _hash160_cache:
+        x = 0
+        for c in address:
+            x = x*58 + _base58_table.index(c)
+        # Discard 1-byte network byte at beginning and 4-byte checksum at the end
+        _hash160_cache[address] = binascii.unhexlify("%050x" % x)[1:21]
+    return _hash160_cache[address]
+
+# Pay to pubkey hash output script of a Base58 Bitcoin address
+def p2pkh_script(address):
+    # OP_DUP OP_HASH160 <len to push> <pubkey> OP_EQUALVERIFY OP_CHECKSIG
+    return "\x76\xa9\x14" + address_hash160(address) + "\x88\xac"
+
+# Create a coinbase transaction
+#
+# Arguments:
+#       coinbase_script:    (string) binary script
+#       address:            (base58 string) bitcoin address
+#       value:              (unsigned int) value
+#
+# Returns binary transaction data, same layout as ntgbtminer.tx_make_coinbase
+def make_coinbase(coinbase_script, address, value):
+    pubkey_script = p2pkh_script(address)
+    return "".join((
+        COINBASE_PREFIX,
+        varint(len(coinbase_script)), coinbase_script,
+        "\xff\xff\xff\xff",
+        "\x01",
+        _u64_struct.pack(value),
+        varint(len(pubkey_script)), pubkey_script,
+        "\x00\x00\x00\x00",
+    ))
+
+class CoinbaseTemplate(object):
+    '''Coinbase compiled once per block template: constant prefix (up to and
+    including the coinbase message), a fixed width little endian extranonce
+    slot at the end of the script and the constant suffix. The prefix is
+    absorbed once into a hashlib.sha256 object, rolling the extranonce
+    patches the slot in place and hashes the tail only.'''
+
+    def __init__(self, coinbase_message, address, value, extranonce_size=4):
+        if extranonce_size not in (4, 8):
+            raise ValueError('extranonce_size must be 4 or 8')
+        pubkey_script = p2pkh_script(address)
+        prefix = COINBASE_PREFIX + varint(len(coinbase_message) + extranonce_size) + coinbase_message
+        suffix = "".join((
+            "\xff\xff\xff\xff",
+            "\x01",
+            _u64_struct.pack(value),
+            varint(len(pubkey_script)), pubkey_script,
+            "\x00\x00\x00\x00",
+        ))
+        self.offset = len(prefix)
+        self.data = bytearray(prefix + "\x00"*extranonce_size + suffix)
+        self._extranonce_struct = _u32_struct if extranonce_size == 4 else _u64_struct
+        self._prefix_hash = hashlib.sha256(prefix)
+
+    # Patch the extranonce slot
+    def set_extranonce(self, extranonce):
+        self._extranonce_struct.pack_into(self.data, self.offset, extranonce)
+
+    # Returns the binary coinbase transaction for extranonce. It works on a
+    # copy, so it may be called while another thread rolls txid().
+    def coinbase(self, extranonce):
+        data = bytearray(self.data)
+        self._extranonce_struct.pack_into(data, self.offset, extranonce)
+        return bytes(data)
+
+    # Returns the coinbase txid (internal byte order) for extranonce
+    def txid(self, extranonce):
+        self.set_extranonce(extranonce)
+        first = self._prefix_hash.copy()
+        first.update(buffer(self.data, self.offset))
+        return hashlib.sha256(first.digest()).digest()
+
+# Transactions of at least this many bytes are hashed on the thread pool,
+# hashlib releases the GIL for inputs longer than 2047 bytes
+THREADED_TX_SIZE = 2048
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+# Returns the txid of binary transaction data in internal byte order
+def txid(data):
+    return double_sha256(data)
+
+def _read_varint(data, pos):
+    prefix = ord(data[pos])
+    if prefix < 0xfd: return (prefix, pos + 1)
+    elif prefix == 0xfd: return (_u16_struct.unpack_from(data, pos + 1)[0], pos + 3)
+    elif prefix == 0xfe: return (_u32_struct.unpack_from(data, pos + 1)[0], pos + 5)
+    else: return (_u64_struct.unpack_from(data, pos + 1)[0], pos + 9)
+
+# Offset of the end of the outputs of a segwit transaction (BIP144), where
+# the witnesses start
+def _outputs_end(data):
+    # Version, marker and flag
+    pos = 6
+    (count, pos) = _read_varint(data, pos)
+    for i in xrange(count):
+        # Previous output hash and index, script, sequence
+        (length, pos) = _read_varint(data, pos + 36)
+        pos += length + 4
+    (count, pos) = _read_varint(data, pos)
+    for i in xrange(count):
+        # Value, script
+        (length, pos) = _read_varint(data, pos + 8)
+        pos += length
+    return pos
+
+# Returns (txid, wtxid) of binary transaction data in internal byte order.
+# For segwit transactions the txid is hashed over the data without marker,
+# flag and witnesses, fed to hashlib as buffers so nothing is copied.
+def tx_hashes(data):
+    wtxid = double_sha256(data)
+    if data[4:6] != "\x00\x01":
+        return (wtxid, wtxid)
+    outputs_end = _outputs_end(data)
+    first = hashlib.sha256(buffer(data, 0, 4))
+    first.update(buffer(data, 6, outputs_end - 6))
+    first.update(buffer(data, len(data) - 4))
+    return (hashlib.sha256(first.digest()).digest(), wtxid)
+
+# Compute (txid, wtxid) of many transactions
+#
+# Arguments:
+#       datas:      (list) binary transaction data
+#
+# Transactions of THREADED_TX_SIZE bytes or more go to a pool of
+# config.TXID_THREADS threads, the small ones (hashing them is cheaper than
+# handing them over) are hashed inline meanwhile. Returns the list of
+# (txid, wtxid) in the order of datas.
+def compute_tx_hashes(datas):
+    global _thread_pool
+    large = []
+    if TXID_THREADS > 1:
+        large = [i for i in xrange(len(datas)) if len(datas[i]) >= THREADED_TX_SIZE]
+    pending = None
+    if large:
+        with _thread_pool_lock:
+            if _thread_pool is None:
+                _thread_pool = ThreadPool(TXID_THREADS)
+            pending = _thread_pool.map_async(tx_hashes, [datas[i] for i in large])
+
+    large_set = set(large)
+    hashes = [None if i in large_set else tx_hashes(datas[i]) for i in xrange(len(datas))]
+    if pending is not None:
+        for (i, result) in zip(large, pending.get()):
+            hashes[i] = result
+    return hashes
+
+# Stop the threads of compute_tx_hashes() once the hashes handed to them are
+# done, the next call starts new ones. Also run at exit.
+def close_thread_pool():
+    global _thread_pool
+    with _thread_pool_lock:
+        if _thread_pool is not None:
+            _thread_pool.close()
+            _thread_pool.join()
+            _thread_pool = None
+
+atexit.register(close_thread_pool)
+
+# Merkle root (internal byte order) of binary transactions without known
+# txids, the txids go straight into merkle_root() as one string
+def transactions_merkle_root(datas):
+    return merkle_root("".join([tx_hash[0] for tx_hash in compute_tx_hashes(datas)]))
+
+# Compute the Merkle root of txids in internal byte order
+#
+# Arguments:
+#       txids:      (list) 32 byte txids, or (string) their concatenation
+#
+# The tree is built level by level in one preallocated bytearray: the level
+# below is read through a memoryview and every level is hashed in one list
+# comprehension and written back over its own first half, there are no per
+# node list or string operations apart from the hashes themselves.
+def merkle_root(txids):
+    if not isinstance(txids, (str, bytearray)):
+        txids = "".join(txids)
+    count = len(txids) // 32
+    if count == 0 or len(txids) % 32 != 0:
+        raise ValueError('txids must be a non empty multiple of 32 bytes')
+
+    # One spare slot for the duplicated last hash of an odd level
+    buf = bytearray(len(txids) + 32)
+    buf[0:len(txids)] = txids
+    view = memoryview(buf)
+    sha256 = hashlib.sha256
+    while count > 1:
+        # Duplicate last hash if the level is odd
+        if count % 2 != 0:
+            buf[32*count:32*count + 32] = view[32*count - 32:32*count]
+            count += 1
+        buf[0:16*count] = "".join([sha256(sha256(view[i:i+64]).digest()).digest() for i in xrange(0, 32*count, 64)])
+        count //= 2
+    return bytes(buf[0:32])
+
+# Merkle branch of the coinbase: the sibling hashes along the leftmost path
+# of the tree, txids are the template transactions without the coinbase
+def merkle_branch(txids):
+    branch = []
+    # Slot 0 is the (unknown) coinbase side of the path
+    level = [None] + list(txids)
+    while len(level) > 1:
+        branch.append(level[1])
+        # Duplicate last hash if the list is odd
+        if len(level) % 2 != 0:
+            level.append(level[-1])
+        level = [None] + [double_sha256(level[i] + level[i+1]) for i in xrange(2, len(level), 2)]
+    return branch
+
+# Fold a coinbase txid up its Merkle branch, returns the Merkle root in
+# log2(n) double hashes
+def merkle_root_from_branch(coinbase_txid, branch):
+    root = coinbase_txid
+    for sibling in branch:
+        root = double_sha256(root + sibling)
+    return root
+
+# Returns version with the bits selected by mask replaced by the bits of n,
+# lowest mask bit first (n counts from 0 to 2**popcount(mask) - 1)
+def rolled_version(version, mask, n):
+    version &= ~mask
+    while n and mask:
+        low_bit = mask & -mask
+        if n & 1:
+            version |= low_bit
+        n >>= 1
+        mask ^= low_bit
+    return version
+
+# Convert compact bits (int) to a target in big endian binary
+def bits2target(bits):
+    shift = (bits >> 24) - 3
+    value = struct.pack(">L", bits & 0xffffff)[1:]
+    target = value + "\x00"*shift
+    # A mantissa moved down a byte for its sign bit (size 33) spills over the
+    # top, the bytes past 32 are the padding of the exponent
+    return "\x00"*(32-len(target)) + target[-32:]
+
+# Compact bits of a big endian binary target, the inverse of bits2target().
+# Digits below the 3 byte mantissa are dropped, so the target the bits
+# stand for is never above target.
+def target2bits(target):
+    digits = target.lstrip("\x00")
+    size = len(digits)
+    mantissa = int(binascii.hexlify(digits[0:3].ljust(3, "\x00")), 16)
+    # The mantissa is signed, its top bit must stay clear
+    if mantissa & 0x800000:
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+
+class Transaction(object):
+    '''A template transaction, data, txid and wtxid as byte strings, the
+    hashes are None until known'''
+
+    def __init__(self, data, txid_=None, wtxid=None):
+        self.data = data
+        self.txid = txid_
+        self.wtxid = wtxid
+
+    @classmethod
+    def from_rpc(cls, tx):
+        data = binascii.unhexlify(tx['data'])
+        # 'txid' is the segwit era name of the field, 'hash' then is the wtxid
+        if 'txid' in tx:
+            (txid_hex, wtxid_hex) = (tx['txid'], tx.get('hash'))
+        else:
+            (txid_hex, wtxid_hex) = (tx.get('hash'), None)
+        return cls(data,
+                   binascii.unhexlify(txid_hex)[::-1] if txid_hex else None,
+                   binascii.unhexlify(wtxid_hex)[::-1] if wtxid_hex else None)
+
+# Fill in the missing txids (and wtxids) of transactions with
+# compute_tx_hashes()
+def fill_tx_hashes(transactions):
+    missing = [tx for tx in transactions if tx.txid is None]
+    if not missing:
+        return
+    for (tx, (txid_, wtxid)) in zip(missing, compute_tx_hashes([tx.data for tx in missing])):
+        tx.txid = txid_
+        tx.wtxid = wtxid
+
+
+class BlockTemplate(object):
+    '''Binary form of a getblocktemplate result (without coinbase)'''
+
+    def __init__(self, version, previous_hash, curtime, bits, coinbasevalue, transactions, mintime=None, maxtime=None, mutable=(),
+                 vbavailable=None, vbrequired=0):
+        self.version = version
+        self.previous_hash = previous_hash
+        self.curtime = curtime
+        self.bits = bits
+        self.coinbasevalue = coinbasevalue
+        self.transactions = transactions
+        self.mintime = mintime
+        self.maxtime = maxtime
+        self.mutable = mutable
+        self.vbavailable = vbavailable or {}
+        self.vbrequired = vbrequired
+        self.target = bits2target(bits)
+        self._merkle_branch = None
+
+    # merkle_tree is an optional merkle.MerkleTree kept between templates, it
+    # is updated with the new txids and gives the coinbase branch
+    @classmethod
+    def from_rpc(cls, template, merkle_tree=None):
+        model = cls(template['version'],
+                    binascii.unhexlify(template['previousblockhash'])[::-1],
+                    template['curtime'],
+                    int(template['bits'], 16),
+                    template['coinbasevalue'],
+                    [Transaction.from_rpc(tx) for tx in template['transactions'] if tx],
+                    template.get('mintime'),
+                    template.get('maxtime'),
+                    template.get('mutable', ()),
+                    template.get('vbavailable'),
+                    template.get('vbrequired', 0))
+        fill_tx_hashes(model.transactions)
+        if merkle_tree is not None:
+            model._merkle_branch = merkle_tree.update(model.txids()).branch()
+        return model
+
+    def txids(self):
+        return [tx.txid for tx in self.transactions]
+
+    # Returns the coinbase transaction for the coinbase script
+    def coinbase(self, coinbase_script, address):
+        return make_coinbase(coinbase_script, address, self.coinbasevalue)
+
+    # Returns the CoinbaseTemplate paying the template value to address
+    def coinbase_template(self, coinbase_message, address, extranonce_size=4):
+        return CoinbaseTemplate(coinbase_message, address, self.coinbasevalue, extranonce_size)
+
+    # Coinbase Merkle branch, computed on first use and kept for the lifetime
+    # of the template
+    def merkle_branch(self):
+        if self._merkle_branch is None:
+            self._merkle_branch = merkle_branch(self.txids())
+        return self._merkle_branch
+
+    # Returns the Merkle root for a coinbase txid
+    def merkle_root(self, coinbase_txid):
+        return merkle_root_from_branch(coinbase_txid, self.merkle_branch())
+
+    # Returns the 80 byte header
+    def header(self, merkle_root_, nonce=0, curtime=None, version=None):
+        return HEADER_STRUCT.pack(self.version if version is None else version, self.previous_hash, merkle_root_,
+                                  self.curtime if curtime is None else curtime, self.bits, nonce)
+
+    # Returns the BIP320 bits that may be rolled in this template: none
+    # without config.VERSION_ROLLING or BIP9 top bits, never a bit the
+    # template version already sets, a deployment offered in vbavailable
+    # signals on or vbrequired asks for
+    def version_mask(self):
+        if not VERSION_ROLLING or (self.version & VERSION_BITS_TOP_MASK) != VERSION_BITS_TOP:
+            return 0
+        mask = VERSION_ROLLING_MASK & ~self.version & ~self.vbrequired
+        for bit in self.vbavailable.values():
+            mask &= ~(1 << bit)
+        return mask
+
+    # Returns (first, last) header time usable with one Merkle root. Times are
+    # only rolled forward and only if the template marks them mutable, up to
+    # maxtime and at most config.NTIME_ROLL_LIMIT seconds past curtime.
+    def ntime_range(self):
+        first = self.curtime if self.mintime is None else max(self.curtime, self.mintime)
+        if 'time' not in self.mutable and 'time/increment' not in self.mutable:
+            return (first, first)
+        last = self.curtime + NTIME_ROLL_LIMIT
+        if self.maxtime is not None:
+            last = min(last, self.maxtime)
+        return (first, max(first, last))
+
+    # Generate (extranonce, ntime, header) from extranonce_start on. Every
+    # ntime of ntime_range() is used (same midstate, new tail) before the
+    # version is rolled within version_mask() (new midstate), and all of them
+    # before the extranonce (and with it the coinbase and the Merkle root).
+    def headers(self, coinbase_template, extranonce_start=0, extranonce_end=0xffffffff):
+        (first, last) = self.ntime_range()
+        mask = self.version_mask()
+        for extranonce in xrange(extranonce_start, extranonce_end + 1):
+            merkle_root_ = self.merkle_root(coinbase_template.txid(extranonce))
+            for n in xrange(1 << bin(mask).count("1")):
+                version = rolled_version(self.version, mask, n)
+                for ntime in xrange(first, last + 1):
+                    yield (extranonce, ntime, self.header(merkle_root_, 0, ntime, version))
+
+    # Returns the submitblock hex of a solved header with its coinbase
+    def submit_hex(self, header, coinbase):
+        parts = [header, varint(len(self.transactions) + 1), coinbase]
+        parts.extend(tx.data for tx in self.transactions)
+        return binascii.hexlify("".join(parts))
+
+# Write a solved block back into the RPC block template (dict) in the hex
+# fields ntgbtminer.block_mine returns: the coinbase as transactions[0],
+# 'merkleroot', 'nonce' and 'hash'
+def update_rpc_template(block_template, coinbase, header):
+    (version, previous_hash, merkle_root_, curtime, bits, nonce) = HEADER_STRUCT.unpack(header)
+    coinbase_tx = {'data': binascii.hexlify(coinbase), 'hash': binascii.hexlify(txid(coinbase)[::-1])}
+    if block_template['transactions'] and not block_template['transactions'][0]:
+        block_template['transactions'][0] = coinbase_tx
+    else:
+        block_template['transactions'].insert(0, coinbase_tx)
+    block_template['merkleroot'] = binascii.hexlify(merkle_root_[::-1])
+    block_template['version'] = version
+    block_template['curtime'] = curtime
+    block_template['nonce'] = nonce
+    block_template['hash'] = binascii.hexlify(double_sha256(header)[::-1])
+    return block_template
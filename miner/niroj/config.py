@@ -9,4 +9,20 @@ DEBUG_LOCAL_DATA = False
 TARGET_REDUCE = "000fffff"
 PUBLIC_KEY = "mxWqotbFkgBNAziCFHTUpkws8YHootQHD8" #PUBLICKEY FOR account nirojpokhrel
 COINBASE_MSG = "Any message you want to put in coinbase transactions!!!"
-REDUCE_NONCE = True
\ No newline at end of file
+REDUCE_NONCE = True
+CPU_WORKERS = 1 #Number of processes used by the PC miner, more than 1 shards the nonce range
+CPU_ENGINE = "hashlib" #PC miner engine: "hashlib" (midstate copy) or "numpy" (nonce_batch)
+TXID_THREADS = 4 #Threads hashing template transactions of 2 KB or more that come without txid, 1 hashes inline
+PREFETCH_DEPTH = 4 #Prepared work units kept ahead of the miner by work_queue.WorkGenerator
+TEMPLATE_POLL_INTERVAL = 5 #Seconds between two getblocktemplate calls of the work generator
+NTIME_ROLL_LIMIT = 600 #Seconds the header time may be rolled past the template curtime before a new extranonce is used
+VERSION_ROLLING = True #Roll the BIP320 version bits (0x1fffe000) the template leaves free before a new extranonce is used
+HYBRID_MINING = False #Mine on the FPGA and the PC at once: with one board every work unit on disjoint nonce ranges (see hybrid_miner), with several FPGA_PORTS the PC on units of its own
+FPGA_HASHRATE = 1000000 #Initial estimate of the FPGA hashes per second, replaced by measured rates
+CPU_HASHRATE = 100000 #Initial estimate of the PC miner hashes per second, replaced by measured rates
+HASHRATE_SMOOTHING = 0.5 #Weight of a new hashrate measurement in the moving averages of hybrid_miner
+FPGA_PORTS = [PORT_ADDRESS] #Serial ports of the boards mined at once through pipeline.MiningPipeline when submitting
+SERIAL_PROTOCOL = "text" #Board protocol: "text" lines with echo checks or "binary" CRC checked frames (serial_comm.FramedSerial)
+JOB_SLOTS = 1 #Jobs queued on a board, with more the next one is sent while it hashes the current one. Needs firmware with a job queue.
+SERIAL_ABORT = False #The board firmware understands ABORT, a new block then stops its jobs at once. Without it a stale job runs until it ends.
+SERIAL_JOB_IDS = False #The board firmware understands JOB <id> and tags its Nonce:/Fail lines with it, without it the jobs are matched in order
@@ -0,0 +1,97 @@
+import hashlib
+import struct
+import midstate
+import nonce_batch
+from config import CPU_ENGINE
+
+'''
+CPU nonce search shared by the PC miners. Three engines are available:
+    "hashlib" - the constant first 64 header bytes are absorbed once into a
+                hashlib.sha256 object, every nonce only copies it and feeds
+                the last 16 bytes. Default.
+    "numpy"   - nonce_batch, the second chunk and second hash of a whole batch
+                of nonces as numpy uint32 lanes, the second hash stops at
+                round 60 for the nonces whose top word misses the target.
+    "python"  - midstate.MidstateJob, the second chunk in pure Python resumed
+                from round 3 (reference for the FPGA debug path).
+The hashlib and python engines always hash each nonce in full, hashlib runs
+the second hash as one C call and cannot stop it early.
+'''
+
+# Nonces per scan_nonces() call, callers check timeouts and stop flags between
+# two calls
+BATCH_SIZE = 1 << 15
+
+_nonce_struct = struct.Struct("<L")
+
+
+# Hashlib engine, see scan_nonces()
+def scan_nonces_hashlib(header, target_hash, nonce_start=0, count=BATCH_SIZE):
+    prefix = hashlib.sha256(header[0:64])
+    # Last 16 header bytes, the nonce is patched in place
+    tail = bytearray(header[64:76] + "\x00"*4)
+    pack_into = _nonce_struct.pack_into
+    sha256 = hashlib.sha256
+
+    found = []
+    for nonce in xrange(nonce_start, min(nonce_start + count, 0x100000000)):
+        pack_into(tail, 12, nonce)
+        first = prefix.copy()
+        first.update(tail)
+        block_hash = sha256(first.digest()).digest()
+        if block_hash[::-1] <= target_hash:
+            found.append(nonce)
+    return found
+
+# Pure Python engine, see scan_nonces()
+def scan_nonces_python(header, target_hash, nonce_start=0, count=BATCH_SIZE):
+    job = midstate.MidstateJob(header[64:76], midstate.calculateMidstate(header[0:64]))
+    sha256 = hashlib.sha256
+
+    found = []
+    for nonce in xrange(nonce_start, min(nonce_start + count, 0x100000000)):
+        block_hash = sha256(midstate.calculateNonceMidstate(job, nonce)).digest()
+        if block_hash[::-1] <= target_hash:
+            found.append(nonce)
+    return found
+
+# (first 64 header bytes, their midstate) of the last numpy scan, the callers
+# scan one header batch after batch
+_numpy_midstate = (None, None)
+
+# Numpy engine, see scan_nonces()
+def scan_nonces_numpy(header, target_hash, nonce_start=0, count=BATCH_SIZE):
+    global _numpy_midstate
+    (chunk, header_midstate) = _numpy_midstate
+    if chunk != header[0:64]:
+        header_midstate = midstate.calculateMidstate(header[0:64])
+        _numpy_midstate = (header[0:64], header_midstate)
+    return nonce_batch.scan_nonces(header_midstate, header[64:76], target_hash, nonce_start, count)
+
+ENGINES = {
+    "hashlib": scan_nonces_hashlib,
+    "numpy": scan_nonces_numpy,
+    "python": scan_nonces_python,
+}
+
+# Hash count nonces of a block header starting at nonce_start
+#
+# Arguments:
+#       header:         (string) binary block header, the nonce bytes are ignored
+#       target_hash:    (string) target in big endian binary
+#
+# Returns the list of nonces whose block hash meets the target.
+def scan_nonces(header, target_hash, nonce_start=0, count=BATCH_SIZE, engine=None):
+    return ENGINES[engine or CPU_ENGINE](header, target_hash, nonce_start, count)
+
+# Returns the first nonce in [nonce_start, nonce_end] meeting the target or
+# None if the range is exhausted
+def search_nonce(header, target_hash, nonce_start=0, nonce_end=0xffffffff, engine=None):
+    nonce = nonce_start
+    while nonce <= nonce_end:
+        count = min(BATCH_SIZE, nonce_end - nonce + 1)
+        found = scan_nonces(header, target_hash, nonce, count, engine)
+        if found:
+            return found[0]
+        nonce += count
+    return None
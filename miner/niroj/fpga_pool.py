@@ -0,0 +1,205 @@
+import os
+import select
+import time
+import hybrid_miner
+from config import TARGET_REDUCE
+
+'''
+Several FPGA boards, each on its own serial port, driven from one host
+thread. Every board gets its own work unit (the units of a
+work_queue.WorkGenerator differ in extranonce, header time or version), so
+no two boards hash the same header. Jobs are sent to all boards, then
+select() waits on every port at once and whichever board reports first is
+given its next unit right away. No thread is started per board. A board with
+several job slots (see serial_comm.MySerial) is kept filled: its next unit is
+sent while it hashes the current one, so it goes on hashing while the host
+reads a result and hands over the next job.
+
+preempt() (e.g. from a work_queue.WorkGenerator listener on a new block)
+wakes the select() up through a pipe, every board still running a stale unit
+is aborted and restarted on fresh work without waiting for its job to end,
+if its firmware supports the abort (see serial_comm.MySerial.abort()).
+Nonces a board reports for an aborted or older job are matched to their unit
+by job id and handed over like any other result.
+
+A board that does not take its job (no echo, a rejected frame or the serial
+timeout) stays in the pool, it is sent a new job on the next pass of run()
+and its port is reopened after REOPEN_FAILURES failures in a row.
+'''
+
+# Seconds select() waits before checking the stop condition again
+POLL_INTERVAL = 0.1
+# Failed jobs in a row after which the port of a board is reopened
+REOPEN_FAILURES = 3
+
+
+class FpgaPool(object):
+    '''Mines distinct work units on several FPGA boards
+
+    Arguments:
+        ports:          list of serial_comm.MySerial or FramedSerial, one per board
+    Optional Arguments:
+        target_reduce:  see hybrid_miner.SerialDevice
+    '''
+
+    def __init__(self, ports, target_reduce=TARGET_REDUCE):
+        self.devices = [hybrid_miner.SerialDevice(port, target_reduce) for port in ports]
+        # Units on each board, the running one first, and the start time of
+        # the running one
+        self.units = [[] for device in self.devices]
+        self.started = [0] * len(self.devices)
+        # Nonces hashed and seconds spent on jobs per board
+        self.hashes = [0] * len(self.devices)
+        self.busy = [0.0] * len(self.devices)
+        # Seconds from preempt() to the new job being sent, per restart
+        self.restart_latency = []
+        # Seconds a board sat without a job between the end of one and the
+        # start of the next, 0 when the next one was already queued
+        self.gaps = []
+        # Jobs in a row each board did not take
+        self.failures = [0] * len(self.devices)
+        self._ended = [None] * len(self.devices)
+        # get_work() returned None last time
+        self._out_of_work = False
+        self._preempted = 0
+        (self._wake_read, self._wake_write) = os.pipe()
+
+    # Hashes per second of every board
+    def hashrates(self):
+        return [0 if busy == 0 else hashes / busy for (hashes, busy) in zip(self.hashes, self.busy)]
+
+    # Hashes per second of the whole pool
+    def hashrate(self):
+        return sum(self.hashrates())
+
+    # Seconds an idle board waited for its next job on average
+    def idle_gap(self):
+        return sum(self.gaps) / len(self.gaps) if self.gaps else 0.0
+
+    # Thread safe: make run() restart every board with a stale unit
+    def preempt(self):
+        self._preempted = time.time()
+        os.write(self._wake_write, b'\x00')
+
+    # Next unit of get_work(), None when there is none
+    def _next_unit(self, get_work):
+        unit = get_work()
+        self._out_of_work = unit is None
+        return unit
+
+    # Queue unit on a board, returns False when there is no unit or the board
+    # did not take it
+    def _start(self, index, unit):
+        if unit is None:
+            return False
+        if not self.devices[index].start(unit):
+            self._failed(index)
+            return False
+        self.failures[index] = 0
+        if not self.units[index]:
+            self.started[index] = time.time()
+            if self._ended[index] is not None:
+                self.gaps.append(self.started[index] - self._ended[index])
+        self.units[index].append(unit)
+        return True
+
+    # Send units of get_work() until every job slot of the board is taken
+    def _fill(self, index, get_work):
+        while self.devices[index].free_slots() > 0:
+            if not self._start(index, self._next_unit(get_work)):
+                return
+
+    # The board did not take its job, it is tried again on the next pass of
+    # run(). Reopening the port drops the jobs still on the board.
+    def _failed(self, index):
+        self.failures[index] += 1
+        print "Board", index, "did not take its job,", self.failures[index], "failures in a row"
+        if self.failures[index] % REOPEN_FAILURES == 0:
+            print "Reopening the port of board", index
+            self.devices[index].reopen()
+            self.units[index] = []
+            self._ended[index] = None
+
+    # Account the finished job of a board, returns (unit, nonce or None)
+    def _finish(self, index):
+        (nonce, hashes) = self.devices[index].result()
+        now = time.time()
+        self.hashes[index] += hashes
+        self.busy[index] += now - self.started[index]
+        unit = self.units[index].pop(0)
+        # The board went on with its next queued job right away
+        self.started[index] = now
+        if self.units[index]:
+            self.gaps.append(0.0)
+        else:
+            self._ended[index] = now
+        return (unit, nonce)
+
+    # Abort the boards with a unit that is_stale() and give them new work.
+    # The aborted jobs are left out of the hashrates. Boards that cannot abort
+    # are left to end their jobs and get new work after them, a board whose
+    # restart failed like the ones that did not take a job.
+    def _restart_stale(self, get_work, is_stale, on_result):
+        for index in range(len(self.devices)):
+            if not self.devices[index].can_abort() or not any(is_stale(unit) for unit in self.units[index]):
+                continue
+            unit = self._next_unit(get_work)
+            if unit is None:
+                continue
+            self.units[index] = []
+            self._ended[index] = None
+            if self.devices[index].restart(unit):
+                self.failures[index] = 0
+                self.units[index].append(unit)
+                self.started[index] = time.time()
+            else:
+                self._failed(index)
+            self.restart_latency.append(time.time() - self._preempted)
+            self._late_results(index, on_result)
+
+    def _late_results(self, index, on_result):
+        for (unit, nonce) in self.devices[index].late_results():
+            on_result(index, unit, nonce)
+
+    # Keep every board busy with units of get_work() until stop() returns
+    # True, a board gets no new job while get_work() returns None. Returns
+    # early when no board has a job and get_work() returned None.
+    # on_result(index, unit, nonce) is called for every finished job,
+    # nonce is None when the board found nothing, it may only meet the
+    # reduced target otherwise (see unit.check()). It is called as well for
+    # the late nonces of aborted jobs. After preempt() the boards whose unit
+    # is_stale(unit) are restarted.
+    def run(self, get_work, on_result, stop=lambda: False, is_stale=lambda unit: False):
+        # Every board starts hashing before the others get their queued units
+        for index in range(len(self.devices)):
+            self._start(index, self._next_unit(get_work))
+        for index in range(len(self.devices)):
+            if self.units[index]:
+                self._fill(index, get_work)
+        while not stop():
+            running = [self.devices[index] for index in range(len(self.devices)) if self.units[index]]
+            idle = [index for index in range(len(self.devices)) if not self.units[index]]
+            if not running and self._out_of_work:
+                break
+            ready = [device for device in running if device.has_result()]
+            readable = select.select(running + [self._wake_read], [], [], 0 if ready else POLL_INTERVAL)[0]
+            readable += [device for device in ready if device not in readable]
+            if self._wake_read in readable:
+                os.read(self._wake_read, 4096)
+                readable.remove(self._wake_read)
+                self._restart_stale(get_work, is_stale, on_result)
+            for device in readable:
+                index = self.devices.index(device)
+                finished = device.port.poll_result()
+                self._late_results(index, on_result)
+                while finished:
+                    (unit, nonce) = self._finish(index)
+                    on_result(index, unit, nonce)
+                    finished = device.port.next_result()
+                if not stop():
+                    self._fill(index, get_work)
+            # Boards without a job since the last pass, e.g. after a failed
+            # one, are tried again
+            for index in idle:
+                if not stop() and not self.units[index]:
+                    self._fill(index, get_work)
@@ -0,0 +1,208 @@
+import multiprocessing
+import struct
+import threading
+import time
+import parallel_miner
+import util
+from config import CPU_WORKERS, FPGA_HASHRATE, CPU_HASHRATE, HASHRATE_SMOOTHING, TARGET_REDUCE
+
+'''
+Hybrid mining: the FPGA board and the PC hash the same work unit at once.
+The nonce space is split in two disjoint ranges sized by the measured
+hashrates, the board gets [0, split] and the CPU [split + 1, 0xffffffff],
+so that both reach the end of their range at the same time. Whoever finds a
+nonce meeting the target first stops the other one. Every finished unit
+updates the moving averages of both hashrates, which moves the split for the
+next unit.
+'''
+
+NONCE_SPACE = 0x100000000
+
+
+class SerialDevice(object):
+    '''FPGA board behind a serial_comm.MySerial or FramedSerial
+
+    The serial protocol has no nonce range: the board counts up from nonce 0
+    until it finds a nonce meeting its target or gives up, so it is always
+    given the low end of the split and runs past nonce_end until cancel()
+    aborts the job. Nor can a job be resumed after a nonce, so mine() sends
+    the unit target: with the reduced one the board would only report a
+    share and stop hashing while the CPU still searches.
+    '''
+
+    # target_reduce replaces the first 4 target bytes sent to the board like
+    # miner.fpga_miner(), None sends the unit target
+    def __init__(self, port, target_reduce=TARGET_REDUCE):
+        self.port = port
+        self.target_reduce = target_reduce
+
+    # Hex tail, midstate and target of unit as sent to the board
+    def _job_hex(self, unit, target_reduce):
+        target_hex = util.bin2hex(unit.target)
+        if target_reduce:
+            target_hex = target_reduce + target_hex[8:]
+        return (util.bin2hex(unit.tail), util.bin2hex(unit.midstate), target_hex)
+
+    # Send unit to the board without waiting for the result, it is queued
+    # behind the jobs already there. Returns False when the board did not take
+    # it.
+    def start(self, unit):
+        return self.port.send_job(*self._job_hex(unit, self.target_reduce), context=unit)
+
+    # Jobs the board can take before start() has to wait for a result
+    def free_slots(self):
+        return self.port.free_slots()
+
+    # True when a job ended without the port being readable, see
+    # MySerial.has_result()
+    def has_result(self):
+        return self.port.has_result()
+
+    # True when the board firmware can abort its jobs, see MySerial.abort()
+    def can_abort(self):
+        return self.port.can_abort
+
+    # Abort the queued jobs and start unit, see MySerial.restart()
+    def restart(self, unit):
+        return self.port.restart(*self._job_hex(unit, self.target_reduce), context=unit)
+
+    # Run unit on the board with the unit target until it solves it, gives up
+    # or cancel() aborts it. Returns (nonce or None, nonces hashed, seconds
+    # spent hashing), the job handshake is not timed. Uses one job slot only.
+    def mine(self, unit, nonce_end):
+        if not self.port.send_job(*self._job_hex(unit, None), context=unit):
+            return (None, 0, 0)
+        time_start = time.time()
+        self.port.read_result()
+        time_elapsed = time.time() - time_start
+        (nonce, hashes) = self.result()
+        return (nonce, hashes, time_elapsed)
+
+    # (nonce or None, nonces hashed) of the last finished job, the oldest one
+    # queued
+    def result(self):
+        nonce_hex = self.port.get_nonce()
+        if nonce_hex is None:
+            # Aborted, how far the board got is unknown
+            return (None, 0)
+        if not nonce_hex:
+            return (None, NONCE_SPACE)
+        # The board reports the nonce bytes in header order
+        nonce = struct.unpack("<L", util.hex2bin(nonce_hex))[0]
+        return (nonce, nonce + 1)
+
+    # (unit, nonce) the board reported for older or aborted jobs of this
+    # device, matched by job id, see MySerial.get_late_results()
+    def late_results(self):
+        return [(unit, struct.unpack("<L", util.hex2bin(nonce_hex))[0])
+                for (unit, nonce_hex) in self.port.get_late_results() if unit is not None]
+
+    # Abort the running job, mine() returns at the Abort answer of the board.
+    # Without can_abort() the job runs until it ends.
+    def cancel(self):
+        self.port.abort()
+
+    # Close the port, the jobs on the board are lost, see MySerial.reopen()
+    def reopen(self):
+        self.port.reopen()
+
+    def fileno(self):
+        return self.port.fileno()
+
+class HybridScheduler(object):
+    '''Mines work_queue.WorkUnits on an FPGA device and the CPU at once
+
+    Arguments:
+        device:             FPGA device, SerialDevice or any object with
+                            mine(unit, nonce_end) returning (nonce or None,
+                            nonces hashed, seconds spent hashing) and
+                            cancel()
+    Optional Arguments:
+        cpu_workers:        (int) CPU processes, 1 searches in the calling thread
+        fpga_hashrate:      (float) initial FPGA hashes per second
+        cpu_hashrate:       (float) initial CPU hashes per second
+        smoothing:          (float) weight of a new measurement in the moving
+                            averages of the hashrates
+    '''
+
+    def __init__(self, device, cpu_workers=CPU_WORKERS, fpga_hashrate=FPGA_HASHRATE, cpu_hashrate=CPU_HASHRATE, smoothing=HASHRATE_SMOOTHING):
+        self.device = device
+        self.cpu_workers = cpu_workers
+        self.fpga_hashrate = float(fpga_hashrate)
+        self.cpu_hashrate = float(cpu_hashrate)
+        self.smoothing = smoothing
+        self._device_thread = None
+        self._device_result = None
+        self._stop = None
+
+    # Last nonce of the FPGA range, the CPU gets the rest. At the current
+    # hashrates both ranges take the same time.
+    def split(self):
+        share = self.fpga_hashrate / (self.fpga_hashrate + self.cpu_hashrate)
+        return min(max(int(NONCE_SPACE * share), 1), NONCE_SPACE - 1) - 1
+
+    def _average(self, rate, measured):
+        return rate + self.smoothing * (measured - rate)
+
+    def _run_device(self, unit, nonce_end, stop):
+        self._device_result = (unit, None, 0, 0)
+        (nonce, hashes, elapsed) = self.device.mine(unit, nonce_end)
+        self._device_result = (unit, nonce, hashes, elapsed)
+        if nonce is not None and unit.check(nonce):
+            stop.set()
+
+    # Wait for the running device job and update the FPGA hashrate, returns
+    # its nonce if it solves the unit
+    def _join_device(self):
+        if self._device_thread is None:
+            return None
+        self._device_thread.join()
+        self._device_thread = None
+        (unit, nonce, hashes, elapsed) = self._device_result
+        if hashes and elapsed > 0:
+            self.fpga_hashrate = self._average(self.fpga_hashrate, hashes / elapsed)
+        if nonce is not None and unit.check(nonce):
+            return nonce
+        return None
+
+    # Search [nonce_start, 0xffffffff] until stop is set, returns
+    # (nonce or None, hashes per second)
+    def _cpu_search(self, unit, nonce_start, stop):
+        if self.cpu_workers > 1:
+            return parallel_miner.double_hash_parallel(unit.header, unit.target, workers=self.cpu_workers, stop=stop, nonce_start=nonce_start)
+        hash_counts = [0]
+        time_start = time.time()
+        nonce = parallel_miner.scan_slice(unit.header, unit.target, nonce_start, 0xffffffff, stop, hash_counts, 0)
+        time_elapsed = time.time() - time_start
+        return (nonce, 0 if time_elapsed == 0 else hash_counts[0] / time_elapsed)
+
+    # Mine unit until the device or the CPU finds a nonce meeting the unit
+    # target or both exhausted their range. Returns the nonce or None.
+    def mine(self, unit):
+        # The board may still be busy with a unit the CPU already solved
+        self._join_device()
+
+        split = self.split()
+        stop = multiprocessing.Event()
+        self._stop = stop
+        self._device_thread = threading.Thread(target=self._run_device, args=(unit, split, stop), name="HybridDevice")
+        self._device_thread.daemon = True
+        self._device_thread.start()
+
+        (nonce, hps) = self._cpu_search(unit, split + 1, stop)
+        if hps:
+            self.cpu_hashrate = self._average(self.cpu_hashrate, hps)
+        if nonce is not None:
+            self.device.cancel()
+            return nonce
+        # The device found the nonce or the CPU range is exhausted
+        return self._join_device()
+
+    # Thread safe: abandon the unit being mined, e.g. on a new block. mine()
+    # returns None once the CPU stopped and the board answered the abort (or
+    # ended its job, see SerialDevice.can_abort()).
+    def preempt(self):
+        stop = self._stop
+        if stop is not None:
+            stop.set()
+            self.device.cancel()
@@ -0,0 +1,86 @@
+import block_model
+
+'''
+Incremental Merkle tree for successive block templates.
+
+Successive getblocktemplate results on the same previous block mostly share
+their transactions. MerkleTree keeps every level of the last tree and, given
+the txids of the next template, compares them position by position with the
+previous ones (a node hash only depends on the txids under it and their
+positions). Only the nodes above a changed, added or removed txid are hashed
+again, the rest is copied from the previous levels.
+
+Like block_model.merkle_branch() slot 0 of every level is the coinbase side
+of the tree and stays None; the coinbase branch is the second node of every
+level.
+'''
+
+
+# Positions of new that have to be recomputed against old, both lists start
+# with the coinbase slot. When the length changes everything from the last
+# common position on is dirty, it may have been (or become) duplicated.
+def _dirty_positions(old, new):
+    common = min(len(old), len(new))
+    dirty = [i for i in xrange(1, common) if old[i] != new[i]]
+    if len(old) != len(new):
+        dirty.extend(xrange(max(common - 1, 1), len(new)))
+    return dirty
+
+class MerkleTree(object):
+    '''Merkle tree of the non coinbase txids of a template, kept between
+    templates'''
+
+    def __init__(self, txids=()):
+        self.levels = [[None]]
+        # Double hashes computed by the last update()
+        self.hash_count = 0
+        if txids:
+            self.update(txids)
+
+    # Replace the txids (internal byte order, without coinbase) and rehash the
+    # dirty paths, returns self
+    def update(self, txids):
+        old_levels = self.levels
+        level = [None] + list(txids)
+        dirty = _dirty_positions(old_levels[0], level)
+        levels = [level]
+        double_sha256 = block_model.double_sha256
+        hash_count = 0
+
+        depth = 0
+        while len(level) > 1:
+            old_parent = old_levels[depth + 1] if depth + 1 < len(old_levels) else [None]
+            parent_len = (len(level) + 1) // 2
+            parent = old_parent[0:parent_len]
+            parent.extend([None] * (parent_len - len(parent)))
+
+            parent_dirty = sorted(set(i >> 1 for i in dirty))
+            if len(old_parent) != parent_len:
+                parent_dirty = sorted(set(parent_dirty).union(xrange(max(min(len(old_parent), parent_len) - 1, 1), parent_len)))
+            last = len(level) - 1
+            for j in parent_dirty:
+                if j == 0:
+                    continue
+                # Duplicate last hash if the level is odd
+                parent[j] = double_sha256(level[2*j] + level[min(2*j + 1, last)])
+                hash_count += 1
+
+            levels.append(parent)
+            level = parent
+            dirty = parent_dirty
+            depth += 1
+
+        self.levels = levels
+        self.hash_count = hash_count
+        return self
+
+    def txids(self):
+        return self.levels[0][1:]
+
+    # Coinbase Merkle branch, see block_model.merkle_branch()
+    def branch(self):
+        return [level[1] for level in self.levels if len(level) > 1]
+
+    # Merkle root for a coinbase txid
+    def root(self, coinbase_txid):
+        return block_model.merkle_root_from_branch(coinbase_txid, self.branch())
@@ -1,6 +1,7 @@
 
 import struct
 import util
+import sha256_unrolled
 
 # Some SHA-256 constants...
 K = [
@@ -26,6 +27,11 @@ F0 = 0x9b05688c
 G0 = 0x1f83d9ab
 H0 = 0x5be0cd19
 
+# Word layouts for both word orders, '>' is the SHA-256 (big endian) order and
+# '<' the little endian byteswapped order the VHDL side uses
+BLOCK_STRUCT = {'>': struct.Struct('>IIIIIIIIIIIIIIII'), '<': struct.Struct('<IIIIIIIIIIIIIIII')}
+STATE_STRUCT = {'>': struct.Struct('>IIIIIIII'), '<': struct.Struct('<IIIIIIII')}
+
 def rotateright(i,p):
     """i>>>p"""
     p &= 0x1F # p mod 32
@@ -34,22 +40,38 @@ def rotateright(i,p):
 def addu32(*i):
     return sum(list(i))&0xFFFFFFFF
 
-def calculateMidstate(data, state=None, rounds=None, debug=False):
+def calculateMidstate(data, state=None, rounds=None, debug=False, byteorder='>'):
     """Given a 512-bit (64-byte) block of (big-endian byteswapped) data,
     calculate a Bitcoin-style midstate. (That is, if SHA-256 were big-endian
     and only hashed the first block of input.)
+
+    byteorder '<' reads data and state and returns the result as little
+    endian words instead (what midstate_little used to do).
     """
     if len(data) != 64:
         raise ValueError('data must be 64 bytes long')
-    w = list(struct.unpack('>IIIIIIIIIIIIIIII', data))
+    block_struct = BLOCK_STRUCT[byteorder]
+    state_struct = STATE_STRUCT[byteorder]
+    w = list(block_struct.unpack(data))
     if debug:
         print w
 
+    # Full compressions go through the unrolled code, the loop below is kept
+    # for partial rounds and for the debug traces
+    if not debug and (rounds == 64 or (rounds is None and state is None)):
+        if state is None:
+            initial = (A0, B0, C0, D0, E0, F0, G0, H0)
+        elif len(state) != 32:
+            raise ValueError('state must be 32 bytes long')
+        else:
+            initial = state_struct.unpack(state)
+        return state_struct.pack(*sha256_unrolled.compress(initial, w))
+
 
     if state is not None:
         if len(state) != 32:
             raise ValueError('state must be 32 bytes long')
-        a,b,c,d,e,f,g,h = struct.unpack('>IIIIIIII', state)
+        a,b,c,d,e,f,g,h = state_struct.unpack(state)
         if debug:
             print "Second iteration:","a=", a, "b=", b, "c=", c, "d=", d, "e=", e, "f=", f, "g=", g, "h=", h
         a_0, b_0, c_0, d_0, e_0, f_0, g_0, h_0 = a,b,c,d,e,f,g,h 
@@ -111,4 +133,99 @@ def calculateMidstate(data, state=None, rounds=None, debug=False):
     gh = h
     if debug:
         print "a=", a, "b=", b, "c=", c, "d=", d, "e=", e, "f=", f, "g=", g, "h=", h
-    return struct.pack('>IIIIIIII', a, b, c, d, e, f, g, h)
+    return state_struct.pack(a, b, c, d, e, f, g, h)
+
+def calculateMidstates(blocks, state=None, byteorder='>'):
+    """calculateMidstate() of many 64 byte blocks in one call.
+
+    blocks is either a list of 64 byte blocks or their concatenation. state
+    is None (SHA-256 initial state), one 32 byte state used for every block
+    or a list with one state per block. All blocks are converted to words in
+    one struct pass. Returns the list of 32 byte midstates.
+    """
+    if not isinstance(blocks, (str, bytearray)):
+        blocks = b''.join(blocks)
+    if len(blocks) % 64 != 0:
+        raise ValueError('blocks must be a multiple of 64 bytes long')
+    count = len(blocks) // 64
+    # struct gives plain ints, array('I') items are Python 2 longs
+    words = struct.unpack('%s%dI' % (byteorder, 16*count), bytes(blocks))
+
+    if state is None or isinstance(state, (str, bytearray)):
+        states = [state] * count
+    else:
+        states = state
+    if len(states) != count:
+        raise ValueError('one state per block is needed')
+
+    state_struct = STATE_STRUCT[byteorder]
+    initial = (A0, B0, C0, D0, E0, F0, G0, H0)
+    compress = sha256_unrolled.compress
+    midstates = []
+    for i in range(count):
+        block_state = initial if states[i] is None else state_struct.unpack(states[i])
+        midstates.append(state_struct.pack(*compress(block_state, words[16*i:16*(i+1)])))
+    return midstates
+
+def calculateVersionMidstates(header, versions):
+    """Midstates of the first 64 bytes of a block header with its version
+    field replaced by every version of versions (BIP320 version rolling).
+    One compression per version, computed in one calculateMidstates() call.
+    """
+    rest = header[4:64]
+    return calculateMidstates([struct.pack('<I', version) + rest for version in versions])
+
+
+def _s0(x):
+    return (x>>7 | x<<25) ^ (x>>18 | x<<14) ^ (x>>3)
+
+def _s1(x):
+    return (x>>17 | x<<15) ^ (x>>19 | x<<13) ^ (x>>10)
+
+class MidstateJob(object):
+    """Nonce invariant part of the second header chunk.
+
+    The second chunk of an 80 byte header is the 12 byte tail, the nonce and
+    constant padding, so only word 3 changes between nonces. The first three
+    rounds, the nonce free part of round 3 and the nonce free terms of the
+    message schedule W16..W19 are computed once here; calculateNonceMidstate()
+    resumes from round 3.
+    """
+
+    def __init__(self, data_remaining, state):
+        if len(data_remaining) != 12:
+            raise ValueError('data_remaining must be 12 bytes long')
+        if len(state) != 32:
+            raise ValueError('state must be 32 bytes long')
+        self.data_remaining = data_remaining
+        self.state = struct.unpack('>IIIIIIII', state)
+        w0, w1, w2 = struct.unpack('>III', data_remaining)
+
+        a,b,c,d,e,f,g,h = self.state
+        for k, w in zip(K[:3], (w0, w1, w2)):
+            s0 = rotateright(a,2) ^ rotateright(a,13) ^ rotateright(a,22)
+            s1 = rotateright(e,6) ^ rotateright(e,11) ^ rotateright(e,25)
+            ma = (a&b) ^ (a&c) ^ (b&c)
+            ch = (e&f) ^ ((~e)&g)
+            h = addu32(h,w,k,ch,s1)
+            d = addu32(d,h)
+            h = addu32(h,ma,s0)
+            a,b,c,d,e,f,g,h = h,a,b,c,d,e,f,g
+        self.rounds3 = (a,b,c,d,e,f,g,h)
+
+        # Round 3 without the nonce word
+        self.t1 = addu32(h, K[3], (e&f) ^ ((~e)&g), rotateright(e,6) ^ rotateright(e,11) ^ rotateright(e,25))
+        self.t2 = addu32((a&b) ^ (a&c) ^ (b&c), rotateright(a,2) ^ rotateright(a,13) ^ rotateright(a,22))
+
+        # Message schedule, W4 = 0x80000000, W5..W14 = 0 and W15 = 640
+        self.w16 = addu32(_s0(w1) & 0xFFFFFFFF, w0)
+        self.w17 = addu32(_s1(640) & 0xFFFFFFFF, _s0(w2) & 0xFFFFFFFF, w1)
+        self.w18 = addu32(_s1(self.w16) & 0xFFFFFFFF, w2)
+        self.w19 = addu32(_s1(self.w17) & 0xFFFFFFFF, _s0(0x80000000) & 0xFFFFFFFF)
+
+def calculateNonceMidstate(job, nonce):
+    """Same result as calculateMidstate() of the second header chunk with
+    the given nonce, starting from the precomputed MidstateJob.
+    """
+    w3 = struct.unpack('<I', struct.pack('>I', nonce))[0]
+    return struct.pack('>IIIIIIII', *sha256_unrolled.nonce_midstate(job, w3))
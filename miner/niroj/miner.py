@@ -10,7 +10,14 @@ import sha256_download
 import serial_comm
 import random
 import midstate_little
-from config import PORT_ADDRESS, DEBUG_LOCAL_DATA, PUBLIC_KEY, COINBASE_MSG, SUBMIT_DATA, TARGET_REDUCE
+import nonce_batch
+import cpu_search
+import parallel_miner
+import block_model
+import work_queue
+import hybrid_miner
+import pipeline
+from config import PORT_ADDRESS, DEBUG_LOCAL_DATA, PUBLIC_KEY, COINBASE_MSG, SUBMIT_DATA, TARGET_REDUCE, CPU_WORKERS, HYBRID_MINING, FPGA_PORTS
 
 
 serial = None
@@ -50,24 +57,8 @@ def compute_hash_of_transaction(tx):
 
 
 def create_merkle_root(tx_hashes):
-    # Convert each hash into a binary string
-    for i in range(len(tx_hashes)):
-        # Reverse the hash from big endian to little endian
-        tx_hashes[i] = util.hex2bin(tx_hashes[i])[::-1]
-
-    while len(tx_hashes) > 1:
-        # Duplicate last hash if the list is odd
-        if len(tx_hashes) % 2 != 0:
-            tx_hashes.append(tx_hashes[-1][:])
-
-        tx_hashes_new = []
-        for i in range(len(tx_hashes)/2):
-            concat = tx_hashes.pop(0) + tx_hashes.pop(0)
-            concat_hash = hashlib.sha256(hashlib.sha256(concat).digest()).digest()
-            tx_hashes_new.append(concat_hash)
-        tx_hashes = tx_hashes_new
-
-    return util.bin2hex(tx_hashes[0][::-1])
+    txids = [util.hex2bin(tx_hash)[::-1] for tx_hash in tx_hashes]
+    return util.bin2hex(block_model.merkle_root(txids)[::-1])
 
 
 def make_header_from_template(block):
@@ -112,19 +103,21 @@ def create_block_for_submission(block):
 
     return submission_block
 
-def fpga_miner(block_template, coinbase_message, extranonce_start, address, timeout=False, debugnonce_start=False, debug=False):
+def fpga_miner(block_template, coinbase_message, extranonce_start, address, timeout=False, debugnonce_start=False, debug=False, merkle_tree=None):
     # Add an empty coinbase transaction to the block template
     if debug:
         print ""
         print "Algorithm start:"
         print ""
-    coinbase_tx = {}
-    block_template['transactions'].insert(0, coinbase_tx)
+    # Binary form of the template, hex is only used again for the serial link
+    # merkle_tree (merkle.MerkleTree) carries the tree over from the previous template
+    template = block_model.BlockTemplate.from_rpc(block_template, merkle_tree)
+    block_template['transactions'].insert(0, {})
     # Add a nonce initialized to zero to the block template
     block_template['nonce'] = 0
 
     # Compute the target hash
-    target_hash = util.bin2hex(block_bits2target(block_template['bits']))
+    target_hash = template.target
     if debug == True:
         print block_template['bits']
         print "target_hash", util.bin2hex(target_hash)
@@ -134,16 +127,11 @@ def fpga_miner(block_template, coinbase_message, extranonce_start, address, time
 
     # Loop through the extranonce
     extranonce = extranonce_start
-    coinbase_script = coinbase_message + util.int2lehex(extranonce, 4)
-    coinbase_tx['data'] = tx_make_coinbase(coinbase_script, address, block_template['coinbasevalue'])
-    coinbase_tx['hash'] = compute_hash_of_transaction(coinbase_tx['data'])
-    
-    # Recompute the merkle root
-    tx_hashes = [tx['hash'] for tx in block_template['transactions']]
-    block_template['merkleroot'] = create_merkle_root(tx_hashes)
-
-    # Reform the block header
-    block_header = make_header_from_template(block_template)
+    coinbase_template = template.coinbase_template(util.hex2bin(coinbase_message), address)
+
+    # Recompute the merkle root and reform the block header
+    block_header = template.header(template.merkle_root(coinbase_template.txid(extranonce)))
+    block_model.update_rpc_template(block_template, coinbase_template.coinbase(extranonce), block_header)
     #Block header should be in big endian#
     #local_hash_little(block_header)
     #local_hash_big(block_header)
@@ -181,6 +169,27 @@ def fpga_miner(block_template, coinbase_message, extranonce_start, address, time
         block_submission(block_template, block_header, ser.get_nonce(), target_hash)
     return
 
+# Submit the block of a work_queue.WorkUnit if nonce solves it, a late nonce
+# is checked against its own unit. Returns True if it was submitted.
+def submit_nonce(unit, nonce):
+    if nonce is None or not unit.check(nonce):
+        return False
+    unit.submit(nonce)
+    return True
+
+# Run a prepared work_queue.WorkUnit on the board and the PC at once through a
+# hybrid_miner.HybridScheduler and submit the block if one of them solves it
+def hybrid_mine_work(scheduler, unit):
+    time_stamp = time.time()
+    nonce = scheduler.mine(unit)
+    print "Time Elapsed( HYBRID - MINER ):", time.time() - time_stamp
+    print "Hashes per second( FPGA / PC ):", scheduler.fpga_hashrate, scheduler.cpu_hashrate
+    submit_nonce(unit, nonce)
+    # Nonces the board found for units it was aborted on
+    for (late_unit, late_nonce) in scheduler.device.late_results():
+        submit_nonce(late_unit, late_nonce)
+    return nonce
+
 def block_submission(block_template, block_header, nonce, target_hash):
     nonce_str = chr(nonce & 0xff) + chr((nonce >> 8) & 0xff) + chr((nonce >> 16) & 0xff) + chr((nonce >> 24) & 0xff)
     block_hash = compute_double_hash_lib_call(block_header+nonce_str)
@@ -199,21 +208,14 @@ def local_sha256( secondhalf, midstate_data, target_hash ):
     print "Local sha256"
     new_target = serial.get_target()
     print "Target received:", new_target
-    nonce = 0
-    while nonce <= 0xffffffff:
-        nonce_str = chr(nonce & 0xff) + chr((nonce >> 8) & 0xff) + chr((nonce >> 16) & 0xff) + chr((nonce >> 24) & 0xff)
-        new_data = nonce_str + util.hex2bin('800000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000280')
-        second_head = secondhalf + new_data
-        temp_hash = midstate.calculateMidstate( second_head, midstate_data, 64 )
-        block_hash = hashlib.sha256(temp_hash).digest()
-        if util.block_check_target(util.bin2hex(block_hash), new_target):
-            print 'nonce_str: ', nonce_str
-            print 'Target hash found for nonce = ', nonce
-            print 'block_hash = ' , util.bin2hex( block_hash )
-            print 'target_hash = ' , new_target
-            return None, 0
-
-        nonce += 1
+    nonce = nonce_batch.search_nonce(midstate_data, secondhalf, util.hex2bin(new_target))
+    if nonce is not None:
+        nonce_str = struct.pack("<L", nonce)
+        block_hash = nonce_batch.hash_nonce(midstate_data, secondhalf, nonce)
+        print 'nonce_str: ', nonce_str
+        print 'Target hash found for nonce = ', nonce
+        print 'block_hash = ' , util.bin2hex( block_hash )
+        print 'target_hash = ' , new_target
 
     return None, 0
 
@@ -230,18 +232,14 @@ def local_sha256_with_nonce( secondhalf, midstate_data, target_hash ):
 
 def double_hash(block_header, target_hash):
     print 'Double hash'
-    nonce = 0
-    while nonce <= 0xffffffff:
-        # Update the block header with the new 32-bit nonce
-        block_header = block_header[0:76] + chr(nonce & 0xff) + chr((nonce >> 8) & 0xff) + chr((nonce >> 16) & 0xff) + chr((nonce >> 24) & 0xff)
-        #block_header = block_header[0:76] + chr(nonce >> 24 & 0xff) + chr((nonce >> 16) & 0xff) + chr((nonce >> 8) & 0xff) + chr(nonce  & 0xff)
-        # Recompute the block hash
-        block_hash = compute_double_hash_lib_call(block_header)
-        if util.block_check_target(block_hash, target_hash):
-            print "nonce: ", nonce
-            print util.bin2hex(block_hash)
-            break
-        nonce += 1
+    if CPU_WORKERS > 1:
+        nonce, hps = parallel_miner.double_hash_parallel(block_header, target_hash, workers=CPU_WORKERS)
+        print "Hashes per second( PC - MINER ):", hps
+    else:
+        nonce = cpu_search.search_nonce(block_header, target_hash)
+    if nonce is not None:
+        print "nonce: ", nonce
+        print util.bin2hex(compute_double_hash_lib_call(block_header[0:76] + struct.pack("<L", nonce)))
 
 
 def local_hash_little(block_header):
@@ -333,9 +331,18 @@ def standalone_miner(coinbase_message, address):
         #performance_measurement_for_different_difficulty()
     else:
         if SUBMIT_DATA:
-            while True:
-                block_template1 = util.rpc_getblocktemplate()
-                fpga_miner(block_template1, coinbase_message, 0, address, timeout=60, debug=False)
+            # Units are prepared in the background while the board hashes
+            work = work_queue.WorkGenerator(util.hex2bin(coinbase_message), address).start()
+            if HYBRID_MINING and len(FPGA_PORTS) == 1:
+                scheduler = hybrid_miner.HybridScheduler(hybrid_miner.SerialDevice(serial))
+                work.add_listener(scheduler.preempt)
+                while True:
+                    hybrid_mine_work(scheduler, work.get())
+            else:
+                # Every board of FPGA_PORTS, a new block preempts them. With
+                # HYBRID_MINING the PC mines units of its own next to them.
+                ports = [serial_comm.make_serial(port) for port in FPGA_PORTS]
+                pipeline.MiningPipeline(work, ports, CPU_WORKERS if HYBRID_MINING else 0).start().join()
         else:
             block_template1 = util.rpc_getblocktemplate()
             fpga_miner(block_template1, coinbase_message, 0, address, timeout=60, debug=False)
@@ -343,5 +350,5 @@ def standalone_miner(coinbase_message, address):
 
 
 if __name__ == "__main__":
-    serial = serial_comm.MySerial(serial_port=PORT_ADDRESS, debug=False)
+    serial = serial_comm.make_serial(PORT_ADDRESS)
     standalone_miner(util.bin2hex(COINBASE_MSG), PUBLIC_KEY)
@@ -0,0 +1,920 @@
+import fcntl
+import hashlib
+import itertools
+import os
+import struct
+import termios
+import threading
+import time
+import unittest
+
+import block_model
+import cpu_search
+import fpga_pool
+import merkle
+import midstate
+import nonce_batch
+import hybrid_miner
+import ntgbtminer
+import parallel_miner
+import pipeline
+import serial_comm
+import sha256_download
+import sha256_unrolled
+import util
+import work_queue
+
+################################################################################
+# Test Data
+################################################################################
+
+# Header (without nonce) and target used by miner.fpga_miner_with_debug_data()
+DEBUG_HEADER = util.hex2bin("000000202fa8edaec2e28b3b6a9f81b2f4dc572e3b76ba87ffd934fe8001000000000000821e03b6e528af7cdeea67e2c59373a4d6b351e036acf6a3f23712df3f08c2f5d0a88857e28a011a")
+EASY_TARGET = util.hex2bin("000fffff" + "ff"*28)
+ADDRESS = "15PKyTs3jJ3Nyf3i6R7D9tfGCY1ZbtqWdv"
+
+def reference_hash(header, nonce):
+    header = header[0:76] + struct.pack("<L", nonce)
+    return hashlib.sha256(hashlib.sha256(header).digest()).digest()[::-1]
+
+def reference_merkle_root(txids):
+    level = list(txids)
+    while len(level) > 1:
+        if len(level) % 2 != 0:
+            level.append(level[-1])
+        level = [hashlib.sha256(hashlib.sha256(level[i] + level[i+1]).digest()).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+def regtest_template():
+    # Minimal template with a regtest difficulty so that mining finishes fast
+    return {
+        'version': 0x20000000,
+        'previousblockhash': "0f9188f13cb7b2c71f2a335e3a4fc328bf5beb436012afca590b1a11466e2206",
+        'curtime': 1296688602,
+        'bits': "207fffff",
+        'coinbasevalue': 5000000000,
+        'transactions': [{'hash': "05f1f0c7fc25005e7c6e56805130b4d540125a8d09f81ec3da621f99ee5d15c1", 'data': "00"}],
+    }
+
+def easy_work_unit():
+    return next(easy_work_units())
+
+class FakeDevice(object):
+    # Returns nonce at once, or waits for cancel() when nonce is None
+    def __init__(self, nonce=None):
+        self.nonce = nonce
+        self.cancelled = threading.Event()
+
+    def mine(self, unit, nonce_end):
+        self.nonce_end = nonce_end
+        if self.nonce is None:
+            self.cancelled.wait(60)
+            return (None, 1000, 0.1)
+        return (self.nonce, self.nonce + 1, 0.1)
+
+    def cancel(self):
+        self.cancelled.set()
+
+class FakeBoard(object):
+    '''Serial port double of the FPGA board. Answers the text protocol of
+    serial_comm.MySerial, or with framed set the binary one of FramedSerial,
+    through a pipe, so it can be select()ed like a real port, and searches
+    the first nonces with nonce_batch. With hold set the jobs never end on
+    their own, they queue up until an abort answers; with late set the nonce
+    of the running held job is reported right before the abort answer. The
+    first corrupt job frames fail their CRC check. With legacy set it is the
+    firmware without the JOB and ABORT commands, their lines are data words.'''
+
+    NONCE_LIMIT = 1 << 16
+
+    def __init__(self, hold=False, late=False, framed=False, corrupt=0, legacy=False):
+        (self._read_fd, self._write_fd) = os.pipe()
+        self._input = ""
+        self.words = []
+        self.jobs = []
+        self.hold = hold
+        self.late = late
+        self.framed = framed
+        self.corrupt = corrupt
+        self.legacy = legacy
+        self.job_id = None
+        self.held = []
+        self.aborts = 0
+
+    def fileno(self):
+        return self._read_fd
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    @property
+    def in_waiting(self):
+        return struct.unpack("I", fcntl.ioctl(self._read_fd, termios.FIONREAD, "\x00"*4))[0]
+
+    def read(self, size=1):
+        return os.read(self._read_fd, size) if size else ""
+
+    def readline(self):
+        line = ""
+        while not line.endswith("\n"):
+            line += os.read(self._read_fd, 1)
+        return line
+
+    def write(self, data):
+        self._input += data
+        if self.framed:
+            self._frames()
+            return
+        while "\n" in self._input:
+            (line, self._input) = self._input.split("\n", 1)
+            self._word(line.strip())
+
+    # Bytes the board sends ahead of its next answer
+    def inject(self, data):
+        os.write(self._write_fd, data)
+
+    def _reply(self, *lines):
+        os.write(self._write_fd, "".join([line + "\r\n" for line in lines]))
+
+    def _reply_frame(self, kind, job_id, value="\x00"*4):
+        os.write(self._write_fd, serial_comm.build_frame(kind, chr(job_id) + value))
+
+    def _job(self, job_id, tail, state, target):
+        self.jobs.append((tail, state, target))
+        # A job sent while others are held waits behind them
+        if self.hold or self.held:
+            self.held.append((job_id, tail, state, target))
+        else:
+            self._result(job_id, tail, state, target)
+
+    def _result(self, job_id, tail, state, target):
+        nonce = nonce_batch.search_nonce(state, tail, target, 0, self.NONCE_LIMIT - 1)
+        if nonce is None and self.framed:
+            self._reply_frame(serial_comm.FRAME_FAIL, job_id)
+        elif nonce is None and job_id is None:
+            self._reply("Fail")
+        elif nonce is None:
+            self._reply("Fail %02x" % job_id)
+        elif self.framed:
+            self._reply_frame(serial_comm.FRAME_NONCE, job_id, struct.pack("<L", nonce))
+        elif job_id is None:
+            self._reply("Nonce: %s" % util.bin2hex(struct.pack("<L", nonce)).upper())
+        else:
+            self._reply("Nonce: %s %02x" % (util.bin2hex(struct.pack("<L", nonce)).upper(), job_id))
+
+    # Let the oldest held job end, like a board without abort finishing it
+    def release(self):
+        self._result(*self.held.pop(0))
+
+    def _abort(self):
+        self.aborts += 1
+        self.words = []
+        if self.held and self.late:
+            self._result(*self.held[0])
+        if self.framed:
+            self._reply_frame(serial_comm.FRAME_ABORTED, self.held[0][0] if self.held else 0)
+        else:
+            self._reply("Abort")
+        self.held = []
+
+    def _frames(self):
+        while len(self._input) >= 5 and len(self._input) >= ord(self._input[1]) + 5:
+            size = ord(self._input[1]) + 5
+            (frame, self._input) = (self._input[0:size], self._input[size:])
+            kind = ord(frame[2])
+            if kind == serial_comm.FRAME_ABORT:
+                self._abort()
+                continue
+            if self.corrupt or struct.unpack(">H", frame[-2:])[0] != serial_comm.frame_crc(frame[1:-2]):
+                self.corrupt = max(self.corrupt - 1, 0)
+                self._reply_frame(serial_comm.FRAME_NAK, 0)
+                continue
+            (job_id, tail, state, bits) = serial_comm.JOB_PAYLOAD.unpack(frame[3:-2])
+            self._reply_frame(serial_comm.FRAME_ACK, job_id)
+            self._job(job_id, tail, state, block_model.bits2target(bits))
+
+    def _word(self, word):
+        if word == serial_comm.ABORT_COMMAND and not self.legacy:
+            self._abort()
+            return
+        if word.startswith(serial_comm.JOB_COMMAND) and not self.legacy:
+            self.job_id = int(word.split()[1], 16)
+            return
+        self.words.append(word)
+        if len(self.words) == 3:
+            self._reply("Data is: " + "".join(self.words).upper(), "", "Input midstate")
+        elif len(self.words) == 11:
+            self._reply("Midstate is: " + "".join(self.words[3:11]).upper(), "Input target")
+        elif len(self.words) == 19:
+            (tail, state, target) = [util.hex2bin("".join(words)) for words in (self.words[0:3], self.words[3:11], self.words[11:19])]
+            self.words = []
+            self._reply("Target is: " + util.bin2hex(target).upper(), "", "OK", "Calculating hashes...")
+            self._job(self.job_id, tail, state, target)
+
+# The port talks to a FakeBoard, legacy drops the JOB and ABORT commands on
+# both sides
+def fake_serial(hold=False, late=False, framed=False, corrupt=0, slots=2, can_abort=True, legacy=False):
+    if framed:
+        port = serial_comm.FramedSerial(debug=False, slots=slots, can_abort=can_abort)
+    else:
+        port = serial_comm.MySerial(debug=False, slots=slots, can_abort=can_abort and not legacy, job_ids=not legacy)
+    port.serial = FakeBoard(hold, late, framed, corrupt, legacy)
+    return port
+
+def easy_work_units(generation=0):
+    template = block_model.BlockTemplate.from_rpc(regtest_template())
+    coinbase_template = template.coinbase_template("\x00", ADDRESS)
+    for (extranonce, ntime, header) in template.headers(coinbase_template):
+        unit = work_queue.WorkUnit(template, coinbase_template, extranonce, header, generation)
+        unit.target = EASY_TARGET
+        yield unit
+
+################################################################################
+# Unit Tests
+################################################################################
+
+class TestMidstate(unittest.TestCase):
+    def test_nonce_midstate(self):
+        header_midstate = midstate.calculateMidstate(DEBUG_HEADER[0:64])
+        job = midstate.MidstateJob(DEBUG_HEADER[64:76], header_midstate)
+        padding = "\x80" + "\x00"*45 + "\x02\x80"
+        for nonce in (0, 1, 0x12345678, 0xffffffff):
+            second_head = DEBUG_HEADER[64:76] + struct.pack("<L", nonce) + padding
+            self.assertEqual(midstate.calculateNonceMidstate(job, nonce), midstate.calculateMidstate(second_head, header_midstate, 64))
+
+    def test_calculate_midstates(self):
+        blocks = [DEBUG_HEADER[0:64], (DEBUG_HEADER * 2)[12:76]]
+        state = midstate.calculateMidstate(blocks[1])
+        self.assertEqual(midstate.calculateMidstates(blocks), [midstate.calculateMidstate(block) for block in blocks])
+        self.assertEqual(midstate.calculateMidstates("".join(blocks), state, '<'),
+                         [midstate.calculateMidstate(block, state, 64, byteorder='<') for block in blocks])
+
+    def test_little_endian(self):
+        # The little endian midstate of byteswapped words is the byteswapped
+        # big endian midstate
+        block = DEBUG_HEADER[0:64]
+        self.assertEqual(midstate.calculateMidstate(util.convetToLittleEndian(block), byteorder='<'),
+                         util.byteswap_words(midstate.calculateMidstate(block)))
+
+class TestUnrolled(unittest.TestCase):
+    def test_compress(self):
+        block = DEBUG_HEADER[0:64]
+        expected = sha256_download.SHA256._process_block(block)
+        self.assertEqual(sha256_unrolled.compress(sha256_unrolled.IV, struct.unpack('>16I', block)), tuple(expected))
+
+    def test_calculate_midstate(self):
+        # A padded single block message is hashed to its midstate
+        message = "abc"
+        block = message + "\x80" + "\x00"*52 + struct.pack('>Q', len(message)*8)
+        self.assertEqual(midstate.calculateMidstate(block), hashlib.sha256(message).digest())
+
+class TestFastSHA256(unittest.TestCase):
+    def test_digest(self):
+        for length in (0, 1, 55, 56, 63, 64, 80, 200):
+            message = DEBUG_HEADER * 3
+            self.assertEqual(sha256_download.FastSHA256(message[:length]).digest(), hashlib.sha256(message[:length]).digest())
+
+    def test_midstate(self):
+        first = sha256_download.FastSHA256(DEBUG_HEADER[0:64])
+        self.assertEqual(first.midstate(), midstate.calculateMidstate(DEBUG_HEADER[0:64]))
+
+        header = DEBUG_HEADER[0:76] + struct.pack("<L", 42)
+        for resumed in (sha256_download.FastSHA256.from_midstate(first.midstate(), 64), first.copy()):
+            resumed.update(header[64:80])
+            self.assertEqual(resumed.digest(), hashlib.sha256(header).digest())
+        self.assertEqual(first.digest(), hashlib.sha256(DEBUG_HEADER[0:64]).digest())
+
+class TestNonceBatch(unittest.TestCase):
+    def test_hash_nonce(self):
+        header_midstate = midstate.calculateMidstate(DEBUG_HEADER[0:64])
+        for nonce in (0, 1, 0x12345678, 0xffffffff):
+            self.assertEqual(nonce_batch.hash_nonce(header_midstate, DEBUG_HEADER[64:76], nonce), reference_hash(DEBUG_HEADER, nonce))
+
+    def test_hash_top_words(self):
+        header_midstate = midstate.calculateMidstate(DEBUG_HEADER[0:64])
+        nonces = nonce_batch.numpy.arange(0, 1000, dtype=nonce_batch.numpy.uint32)
+        top_words = nonce_batch.hash_top_words(header_midstate, DEBUG_HEADER[64:76], nonces)
+        self.assertEqual(list(top_words), list(nonce_batch.hash_nonces(header_midstate, DEBUG_HEADER[64:76], nonces)[0]))
+
+    def test_scan_nonces(self):
+        header_midstate = midstate.calculateMidstate(DEBUG_HEADER[0:64])
+        found = nonce_batch.scan_nonces(header_midstate, DEBUG_HEADER[64:76], EASY_TARGET, 0, 20000)
+        expected = [n for n in range(20000) if reference_hash(DEBUG_HEADER, n) <= EASY_TARGET]
+        self.assertEqual(found, expected)
+
+    def test_scan_nonces_end_of_range(self):
+        header_midstate = midstate.calculateMidstate(DEBUG_HEADER[0:64])
+        found = nonce_batch.scan_nonces(header_midstate, DEBUG_HEADER[64:76], "\xff"*32, 0xfffffff0, 100)
+        self.assertEqual(found, range(0xfffffff0, 0x100000000))
+
+class TestBlockModel(unittest.TestCase):
+    def test_against_hex_pipeline(self):
+        rpc_template = regtest_template()
+        rpc_template['transactions'].append({'hash': ntgbtminer.tx_compute_hash("01" + "ab"*300), 'data': "01" + "ab"*300})
+        template = block_model.BlockTemplate.from_rpc(rpc_template)
+
+        coinbase_hex = ntgbtminer.tx_make_coinbase("00" + ntgbtminer.int2lehex(7, 4), ADDRESS, rpc_template['coinbasevalue'])
+        coinbase = template.coinbase("\x00" + struct.pack("<L", 7), ADDRESS)
+        self.assertEqual(ntgbtminer.bin2hex(coinbase), coinbase_hex)
+
+        rpc_template['transactions'].insert(0, {'data': coinbase_hex, 'hash': ntgbtminer.tx_compute_hash(coinbase_hex)})
+        rpc_template['merkleroot'] = ntgbtminer.tx_compute_merkle_root([tx['hash'] for tx in rpc_template['transactions']])
+        rpc_template['nonce'] = 42
+        header = template.header(template.merkle_root(block_model.txid(coinbase)), 42)
+        self.assertEqual(header, ntgbtminer.block_form_header(rpc_template))
+        self.assertEqual(template.submit_hex(header, coinbase), ntgbtminer.block_make_submit(rpc_template))
+        self.assertEqual(template.target, ntgbtminer.block_bits2target(rpc_template['bits']))
+
+    def test_merkle_root(self):
+        txids = [block_model.txid(chr(i)) for i in range(12)]
+        for count in range(1, 12):
+            self.assertEqual(block_model.merkle_root(txids[0:count]), reference_merkle_root(txids[0:count]))
+        self.assertEqual(block_model.merkle_root("".join(txids)), reference_merkle_root(txids))
+
+    def test_merkle_branch(self):
+        txids = [block_model.txid(chr(i)) for i in range(12)]
+        for count in range(1, 12):
+            branch = block_model.merkle_branch(txids[1:count])
+            self.assertEqual(block_model.merkle_root_from_branch(txids[0], branch), reference_merkle_root(txids[0:count]))
+
+    def test_coinbase_template(self):
+        message = "Hello" * 20
+        coinbase_template = block_model.CoinbaseTemplate(message, ADDRESS, 5000000000)
+        for extranonce in (0, 1, 0xffffffff):
+            coinbase = block_model.make_coinbase(message + struct.pack("<L", extranonce), ADDRESS, 5000000000)
+            self.assertEqual(coinbase_template.txid(extranonce), block_model.txid(coinbase))
+            self.assertEqual(coinbase_template.coinbase(extranonce), coinbase)
+        coinbase_template = block_model.CoinbaseTemplate(message, ADDRESS, 5000000000, 8)
+        coinbase = block_model.make_coinbase(message + struct.pack("<Q", 1 << 40), ADDRESS, 5000000000)
+        self.assertEqual(coinbase_template.txid(1 << 40), block_model.txid(coinbase))
+
+    def test_ntime_rolling(self):
+        rpc_template = regtest_template()
+        template = block_model.BlockTemplate.from_rpc(rpc_template)
+        self.assertEqual(template.ntime_range(), (rpc_template['curtime'], rpc_template['curtime']))
+
+        rpc_template['mutable'] = ["time", "transactions", "prevblock"]
+        rpc_template['maxtime'] = rpc_template['curtime'] + 2
+        template = block_model.BlockTemplate.from_rpc(rpc_template)
+        coinbase_template = template.coinbase_template("\x00", ADDRESS)
+        headers = template.headers(coinbase_template, 5)
+        for (extranonce, ntime, version) in ((5, 0, 0x20000000), (5, 1, 0x20000000), (5, 2, 0x20000000), (5, 0, 0x20002000)):
+            ntime += rpc_template['curtime']
+            header = template.header(template.merkle_root(coinbase_template.txid(extranonce)), 0, ntime, version)
+            self.assertEqual(next(headers), (extranonce, ntime, header))
+
+    def test_version_rolling(self):
+        rpc_template = regtest_template()
+        rpc_template['version'] = 0x20004000
+        rpc_template['vbavailable'] = {"testdummy": 28}
+        template = block_model.BlockTemplate.from_rpc(rpc_template)
+        self.assertEqual(template.version_mask(), 0x0fffa000)
+        self.assertEqual([block_model.rolled_version(0x20004000, 0x0fffa000, n) for n in range(4)],
+                         [0x20004000, 0x20006000, 0x2000c000, 0x2000e000])
+        rpc_template['version'] = 4
+        self.assertEqual(block_model.BlockTemplate.from_rpc(rpc_template).version_mask(), 0)
+
+        # One extranonce and time, every unit is a new version and midstate
+        versions = [0x20000000, 0x20002000, 0x20004000]
+        midstates = midstate.calculateVersionMidstates(DEBUG_HEADER, versions)
+        for (version, version_midstate) in zip(versions, midstates):
+            self.assertEqual(version_midstate, midstate.calculateMidstate(struct.pack("<L", version) + DEBUG_HEADER[4:64]))
+
+    def test_tx_hashes(self):
+        # One input, one output, the segwit form carries one witness item
+        inputs = "\x01" + "\x11"*32 + "\x00"*4 + "\x02\x51\x52" + "\xff"*4
+        outputs = "\x01" + struct.pack("<Q", 1000) + "\xfd\x00\x01" + "\x6a"*256
+        legacy = "\x02\x00\x00\x00" + inputs + outputs + "\x00"*4
+        segwit = "\x02\x00\x00\x00" + "\x00\x01" + inputs + outputs + "\x01\x03" + "\x99"*3 + "\x00"*4
+        self.assertEqual(block_model.tx_hashes(legacy), (block_model.txid(legacy), block_model.txid(legacy)))
+        self.assertEqual(block_model.tx_hashes(segwit), (block_model.txid(legacy), block_model.txid(segwit)))
+
+    def test_compute_tx_hashes(self):
+        datas = [chr(i) * (i * 1000) for i in range(1, 8)]
+        self.assertEqual(block_model.compute_tx_hashes(datas), [block_model.tx_hashes(data) for data in datas])
+        self.assertEqual(block_model.transactions_merkle_root(datas), reference_merkle_root([block_model.txid(data) for data in datas]))
+
+    def test_close_thread_pool(self):
+        datas = [chr(i) * (i * 1000) for i in range(1, 8)]
+        block_model.compute_tx_hashes(datas)
+        block_model.close_thread_pool()
+        self.assertEqual(block_model._thread_pool, None)
+        # The next call starts new threads
+        self.assertEqual(block_model.compute_tx_hashes(datas), [block_model.tx_hashes(data) for data in datas])
+        block_model.close_thread_pool()
+
+    def test_target2bits(self):
+        for bits in (0x207fffff, 0x1d00ffff, 0x1a018ae2):
+            self.assertEqual(block_model.target2bits(block_model.bits2target(bits)), bits)
+        # Rounded down to the 3 byte mantissa
+        self.assertEqual(block_model.target2bits(EASY_TARGET), 0x1f0fffff)
+        self.assertEqual(block_model.target2bits("\x00" + "\xff"*31), 0x2000ffff)
+        self.assertTrue(block_model.bits2target(0x2000ffff) <= "\x00" + "\xff"*31)
+
+    def test_target2bits_top_byte(self):
+        # A top target byte of 0x80 or more needs the 33 byte exponent
+        for target in ("\x80" + "\x00"*31, "\xff\xff" + "\x00"*30):
+            bits = block_model.target2bits(target)
+            self.assertEqual(bits >> 24, 33)
+            self.assertEqual(block_model.bits2target(bits), target)
+            self.assertEqual(block_model.target2bits(block_model.bits2target(bits)), bits)
+
+    def test_address_hash160(self):
+        self.assertEqual(ntgbtminer.bin2hex(block_model.address_hash160(ADDRESS)), ntgbtminer.bitcoinaddress2hash160(ADDRESS))
+
+class TestMerkleTree(unittest.TestCase):
+    def test_update(self):
+        txids = [block_model.txid(str(i)) for i in range(100)]
+        tree = merkle.MerkleTree()
+        for current in (txids[0:50], txids[0:51], txids[0:10] + txids[60:100], txids[0:10] + txids[61:100], [], txids[0:3]):
+            tree.update(current)
+            self.assertEqual(tree.branch(), block_model.merkle_branch(current))
+            self.assertEqual(tree.root(txids[99]), reference_merkle_root([txids[99]] + current))
+
+    def test_append_rehashes_one_path(self):
+        txids = [block_model.txid(str(i)) for i in range(1000)]
+        tree = merkle.MerkleTree(txids[0:999])
+        tree.update(txids)
+        self.assertTrue(tree.hash_count <= 2*10)
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.work = work_queue.WorkGenerator("\x00", ADDRESS, regtest_template, depth=2, poll_interval=60).start()
+
+    def tearDown(self):
+        self.work.stop()
+
+    def test_units(self):
+        template = block_model.BlockTemplate.from_rpc(regtest_template())
+        coinbase_template = template.coinbase_template("\x00", ADDRESS)
+        headers = template.headers(coinbase_template)
+        for i in range(3):
+            unit = self.work.get(timeout=5)
+            (extranonce, ntime, header) = next(headers)
+            self.assertEqual((unit.extranonce, unit.ntime, unit.header), (extranonce, ntime, header[0:76]))
+            self.assertEqual(unit.midstate, midstate.calculateMidstate(unit.header[0:64]))
+        nonce = unit.search()
+        self.assertTrue(unit.check(nonce))
+        self.assertEqual(unit.submit_hex(nonce)[0:160], ntgbtminer.bin2hex(unit.header + struct.pack("<L", nonce)))
+
+    def test_ntime_roll_keeps_midstate(self):
+        rpc_template = regtest_template()
+        rpc_template['mutable'] = ["time"]
+        rpc_template['maxtime'] = rpc_template['curtime'] + 1
+        # Own generator polling the mutable template from the start, so every
+        # unit comes from it
+        work = work_queue.WorkGenerator("\x00", ADDRESS, lambda: rpc_template, depth=2, poll_interval=60).start()
+        try:
+            units = [work.get(timeout=5) for i in range(6)]
+        finally:
+            work.stop()
+        self.assertEqual(units[0].ntime, rpc_template['curtime'])
+        for (previous, unit) in zip(units, units[1:]):
+            self.assertEqual(unit.midstate, midstate.calculateMidstate(unit.header[0:64]))
+            if previous.ntime == rpc_template['curtime']:
+                self.assertEqual((unit.extranonce, unit.ntime), (previous.extranonce, previous.ntime + 1))
+                self.assertTrue(unit.midstate is previous.midstate)
+            else:
+                # Header times exhausted, the version is rolled next
+                self.assertEqual((unit.extranonce, unit.ntime), (previous.extranonce, rpc_template['curtime']))
+                self.assertNotEqual(unit.header[0:4], previous.header[0:4])
+
+    def test_new_block_flushes(self):
+        self.work.get(timeout=5)
+        rpc_template = regtest_template()
+        rpc_template['previousblockhash'] = "11"*32
+        self.assertTrue(self.work.set_template(rpc_template))
+        unit = self.work.get(timeout=5)
+        self.assertEqual(unit.previous_hash, "\x11"*32)
+        self.assertEqual(unit.extranonce, 0)
+
+class TestCpuSearch(unittest.TestCase):
+    def test_engines(self):
+        target = "\x00" + "\xff"*31
+        expected = [n for n in range(3000) if reference_hash(DEBUG_HEADER, n) <= target]
+        for engine in cpu_search.ENGINES:
+            self.assertEqual(cpu_search.scan_nonces(DEBUG_HEADER, target, 0, 3000, engine), expected)
+
+    def test_numpy_header_change(self):
+        # The cached midstate of the previous header must not be reused
+        target = "\x00" + "\xff"*31
+        header = "\x01" + DEBUG_HEADER[1:]
+        cpu_search.scan_nonces(DEBUG_HEADER, target, 0, 100, "numpy")
+        expected = [n for n in range(3000) if reference_hash(header, n) <= target]
+        self.assertEqual(cpu_search.scan_nonces(header, target, 0, 3000, "numpy"), expected)
+
+    def test_search_nonce(self):
+        nonce = cpu_search.search_nonce(DEBUG_HEADER, EASY_TARGET)
+        self.assertTrue(reference_hash(DEBUG_HEADER, nonce) <= EASY_TARGET)
+
+class TestBlockMine(unittest.TestCase):
+    def test_block_mine(self):
+        (mined_block, hps) = ntgbtminer.block_mine(regtest_template(), "00", 0, ADDRESS, timeout=60)
+        header_hash = ntgbtminer.block_compute_raw_hash(ntgbtminer.block_form_header(mined_block))
+        self.assertEqual(ntgbtminer.bin2hex(header_hash), mined_block['hash'])
+        self.assertTrue(ntgbtminer.block_check_target(header_hash, ntgbtminer.block_bits2target("207fffff")))
+
+class TestParallelMiner(unittest.TestCase):
+    def test_nonce_range(self):
+        ranges = [parallel_miner.nonce_range(worker, 3) for worker in range(3)]
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 0xffffffff)
+        for (previous, current) in zip(ranges, ranges[1:]):
+            self.assertEqual(previous[1] + 1, current[0])
+
+    def test_block_mine_parallel(self):
+        (mined_block, hps) = parallel_miner.block_mine_parallel(regtest_template(), "00", 0, ADDRESS, timeout=60, workers=2)
+        header_hash = ntgbtminer.block_compute_raw_hash(ntgbtminer.block_form_header(mined_block))
+        self.assertEqual(ntgbtminer.bin2hex(header_hash), mined_block['hash'])
+        self.assertTrue(ntgbtminer.block_check_target(header_hash, ntgbtminer.block_bits2target("207fffff")))
+
+    def test_double_hash_parallel(self):
+        (nonce, hps) = parallel_miner.double_hash_parallel(DEBUG_HEADER, EASY_TARGET, timeout=60, workers=2)
+        self.assertTrue(reference_hash(DEBUG_HEADER, nonce) <= EASY_TARGET)
+
+    def test_stop(self):
+        stop = parallel_miner.multiprocessing.Event()
+        stop.set()
+        (nonce, hps) = parallel_miner.double_hash_parallel(DEBUG_HEADER, "\x00"*32, workers=2, stop=stop)
+        self.assertEqual(nonce, None)
+
+class TestHybridMiner(unittest.TestCase):
+    def test_split(self):
+        scheduler = hybrid_miner.HybridScheduler(FakeDevice(), fpga_hashrate=3, cpu_hashrate=1)
+        self.assertEqual(scheduler.split(), 0xbfffffff)
+        scheduler.cpu_hashrate = 0
+        self.assertEqual(scheduler.split(), 0xfffffffe)
+
+    def test_cpu_finds(self):
+        unit = easy_work_unit()
+        device = FakeDevice()
+        scheduler = hybrid_miner.HybridScheduler(device, cpu_workers=1, fpga_hashrate=1, cpu_hashrate=1)
+        nonce = scheduler.mine(unit)
+        self.assertTrue(device.cancelled.is_set())
+        self.assertTrue(nonce > device.nonce_end)
+        self.assertTrue(unit.check(nonce))
+        self.assertEqual(scheduler._join_device(), None)
+
+    def test_device_finds(self):
+        unit = easy_work_unit()
+        # The CPU only gets the last nonce, which does not solve the unit
+        self.assertFalse(unit.check(0xffffffff))
+        device = FakeDevice(unit.search())
+        scheduler = hybrid_miner.HybridScheduler(device, cpu_workers=1, fpga_hashrate=1e12, cpu_hashrate=1)
+        self.assertEqual(scheduler.mine(unit), device.nonce)
+        self.assertEqual(device.nonce_end, 0xfffffffe)
+        self.assertNotEqual(scheduler.fpga_hashrate, 1e12)
+
+    def test_preempt(self):
+        unit = easy_work_unit()
+        unit.target = "\x00"*32
+        device = FakeDevice()
+        scheduler = hybrid_miner.HybridScheduler(device, cpu_workers=1)
+        timer = threading.Timer(0.1, scheduler.preempt)
+        timer.start()
+        self.assertEqual(scheduler.mine(unit), None)
+        self.assertTrue(device.cancelled.is_set())
+        timer.join()
+
+    def test_serial_device(self):
+        unit = easy_work_unit()
+        port = fake_serial(slots=1)
+        device = hybrid_miner.SerialDevice(port, target_reduce="ffffffff")
+        (nonce, hashes, elapsed) = device.mine(unit, 0xffffffff)
+        self.assertEqual(nonce, unit.search())
+        self.assertEqual(hashes, nonce + 1)
+        self.assertTrue(elapsed > 0)
+        # The board gets the unit target, not the reduced one
+        self.assertEqual(port.serial.jobs[-1][2], unit.target)
+
+    def test_serial_device_finds(self):
+        unit = easy_work_unit()
+        self.assertFalse(unit.check(0xffffffff))
+        device = hybrid_miner.SerialDevice(fake_serial(slots=1))
+        scheduler = hybrid_miner.HybridScheduler(device, cpu_workers=1, fpga_hashrate=1e12, cpu_hashrate=1)
+        self.assertEqual(scheduler.mine(unit), unit.search())
+        self.assertNotEqual(scheduler.fpga_hashrate, 1e12)
+
+    def test_serial_device_cancelled(self):
+        unit = easy_work_unit()
+        # The board holds the job until the CPU wins and aborts it
+        port = fake_serial(hold=True, slots=1)
+        scheduler = hybrid_miner.HybridScheduler(hybrid_miner.SerialDevice(port), cpu_workers=1, fpga_hashrate=1, cpu_hashrate=1)
+        nonce = scheduler.mine(unit)
+        self.assertTrue(nonce > scheduler.split())
+        self.assertTrue(unit.check(nonce))
+        self.assertEqual(scheduler._join_device(), None)
+        self.assertEqual((port.pending, port.serial.held), ([], []))
+
+class TestSerial(unittest.TestCase):
+    def test_write_data(self):
+        unit = easy_work_unit()
+        port = fake_serial()
+        port.write_data(util.bin2hex(unit.tail), util.bin2hex(unit.midstate), util.bin2hex(unit.target))
+        self.assertEqual(port.get_target(), util.bin2hex(unit.target).upper())
+        self.assertEqual(port.serial.jobs, [(unit.tail, unit.midstate, unit.target)])
+        nonce = struct.unpack("<L", util.hex2bin(port.get_nonce()))[0]
+        self.assertEqual(nonce, unit.search())
+
+    def test_legacy_firmware(self):
+        units = easy_work_units()
+        port = fake_serial(slots=1, legacy=True)
+        pool = fpga_pool.FpgaPool([port], target_reduce=None)
+        results = []
+        pool.run(lambda: next(units), lambda index, unit, nonce: results.append((unit, nonce)), lambda: len(results) >= 3)
+        # Every job was read whole, the nonces without job id match in order
+        self.assertEqual((port.serial.words, port.serial.job_id), ([], None))
+        self.assertEqual(len(port.serial.jobs), 3)
+        self.assertTrue(all(unit.check(nonce) for (unit, nonce) in results))
+
+    def test_restart(self):
+        units = easy_work_units()
+        (first, second) = (next(units), next(units))
+        port = fake_serial(hold=True)
+        self.assertTrue(port.send_job(util.bin2hex(first.tail), util.bin2hex(first.midstate), util.bin2hex(first.target)))
+        port.serial.hold = False
+        self.assertTrue(port.restart(util.bin2hex(second.tail), util.bin2hex(second.midstate), util.bin2hex(second.target)))
+        port.read_result()
+        self.assertEqual(port.serial.jobs[1], (second.tail, second.midstate, second.target))
+        self.assertEqual(struct.unpack("<L", util.hex2bin(port.get_nonce()))[0], second.search())
+
+    def test_restart_without_abort(self):
+        units = easy_work_units()
+        (first, second) = (next(units), next(units))
+        device = hybrid_miner.SerialDevice(fake_serial(hold=True, can_abort=False), target_reduce=None)
+        self.assertFalse(device.can_abort())
+        self.assertTrue(device.start(first))
+        device.port.serial.hold = False
+        device.cancel()
+        # The running job is waited for instead of aborted
+        timer = threading.Timer(0.2, device.port.serial.release)
+        timer.start()
+        self.assertTrue(device.restart(second))
+        timer.join()
+        self.assertEqual(device.port.serial.aborts, 0)
+        self.assertEqual(device.late_results(), [(first, first.search())])
+        device.port.read_result()
+        self.assertEqual(device.result()[0], second.search())
+
+    def test_late_result(self):
+        units = easy_work_units()
+        (first, second) = (next(units), next(units))
+        device = hybrid_miner.SerialDevice(fake_serial(hold=True, late=True), target_reduce=None)
+        self.assertTrue(device.start(first))
+        device.port.serial.hold = False
+        self.assertTrue(device.restart(second))
+        # The nonce of the aborted job is matched to its unit by job id
+        self.assertEqual(device.late_results(), [(first, first.search())])
+        self.assertEqual(device.late_results(), [])
+        device.port.read_result()
+        self.assertEqual(device.result()[0], second.search())
+        self.assertEqual(device.port.get_job(device.port.job_id), second)
+
+    def test_job_slots(self):
+        units = easy_work_units()
+        (first, second) = (next(units), next(units))
+        device = hybrid_miner.SerialDevice(fake_serial(), target_reduce=None)
+        self.assertTrue(device.start(first))
+        self.assertTrue(device.start(second))
+        self.assertEqual(device.free_slots(), 0)
+        # Results come in the order the jobs were sent
+        for unit in (first, second):
+            device.port.read_result()
+            self.assertEqual(device.port.get_job(device.port.result_id), unit)
+            self.assertEqual(device.result()[0], unit.search())
+        self.assertEqual(device.free_slots(), 2)
+
+    def test_abort_slots(self):
+        port = fake_serial(hold=True)
+        for unit in itertools.islice(easy_work_units(), 2):
+            self.assertTrue(port.send_job(util.bin2hex(unit.tail), util.bin2hex(unit.midstate), util.bin2hex(unit.target)))
+        port.abort()
+        # The queued job ends with the running one
+        port.read_result()
+        self.assertEqual(port.get_nonce(), None)
+        self.assertTrue(port.next_result())
+        self.assertEqual(port.get_nonce(), None)
+        self.assertFalse(port.next_result())
+
+    def test_parse_line(self):
+        self.assertEqual(serial_comm.parse_line("Nonce: 0A000000 1f\r\n"), (serial_comm.EVENT_NONCE, 0x1f, "0A000000"))
+        self.assertEqual(serial_comm.parse_line("Nonce: 0A000000\r\n"), (serial_comm.EVENT_NONCE, None, "0A000000"))
+        self.assertEqual(serial_comm.parse_line("Fail 02\r\n"), (serial_comm.EVENT_FAIL, 2, 0))
+        self.assertEqual(serial_comm.parse_line("Target is: 00FF\r\n"), (serial_comm.EVENT_TARGET, None, "00FF"))
+        self.assertEqual(serial_comm.parse_line("Data is: 1234\r\n").kind, serial_comm.EVENT_ECHO)
+        self.assertEqual(serial_comm.parse_line("Calculating hashes...\r\n").kind, serial_comm.EVENT_TEXT)
+        self.assertEqual(serial_comm.parse_line("\r\n"), None)
+
+class TestFramedSerial(unittest.TestCase):
+    def test_write_data(self):
+        unit = easy_work_unit()
+        port = fake_serial(framed=True)
+        # Noise and a broken frame ahead of the answers are skipped
+        port.serial.inject("\x00\xa5\x05\x83garbage")
+        port.write_data(util.bin2hex(unit.tail), util.bin2hex(unit.midstate), util.bin2hex(unit.target))
+        self.assertEqual(port.serial.jobs, [(unit.tail, unit.midstate, block_model.bits2target(0x1f0fffff))])
+        self.assertEqual(struct.unpack("<L", util.hex2bin(port.get_nonce()))[0], unit.search())
+
+    def test_crc_retry(self):
+        unit = easy_work_unit()
+        job = (util.bin2hex(unit.tail), util.bin2hex(unit.midstate), util.bin2hex(unit.target))
+        port = fake_serial(framed=True, corrupt=1)
+        self.assertTrue(port.send_job(*job))
+        port.read_result()
+        self.assertEqual(struct.unpack("<L", util.hex2bin(port.get_nonce()))[0], unit.search())
+        port = fake_serial(framed=True, corrupt=serial_comm.FRAME_RETRIES)
+        self.assertFalse(port.send_job(*job))
+
+    def test_ack_job_id(self):
+        unit = easy_work_unit()
+        port = fake_serial(framed=True)
+        # A stray ACK of another job ahead of the right one is skipped
+        port.serial.inject(serial_comm.build_frame(serial_comm.FRAME_ACK, "\x77" + "\x00"*4))
+        self.assertTrue(port.send_job(util.bin2hex(unit.tail), util.bin2hex(unit.midstate), util.bin2hex(unit.target)))
+        port.read_result()
+        self.assertEqual(port.result_id, port.job_id)
+        self.assertEqual(struct.unpack("<L", util.hex2bin(port.get_nonce()))[0], unit.search())
+
+    def test_late_result(self):
+        units = easy_work_units()
+        (first, second) = (next(units), next(units))
+        device = hybrid_miner.SerialDevice(fake_serial(hold=True, late=True, framed=True), target_reduce=None)
+        self.assertTrue(device.start(first))
+        device.port.serial.hold = False
+        self.assertTrue(device.restart(second))
+        self.assertEqual(device.late_results(), [(first, first.search())])
+        device.port.read_result()
+        self.assertEqual(device.result()[0], second.search())
+
+    def test_pool(self):
+        units = easy_work_units()
+        pool = fpga_pool.FpgaPool([fake_serial(framed=True), fake_serial()], target_reduce=None)
+        results = []
+        pool.run(lambda: next(units), lambda index, unit, nonce: results.append((unit, nonce)), lambda: len(results) >= 4)
+        self.assertTrue(all(unit.check(nonce) for (unit, nonce) in results))
+
+class TestFpgaPool(unittest.TestCase):
+    def test_run(self):
+        units = easy_work_units()
+        pool = fpga_pool.FpgaPool([fake_serial(), fake_serial()], target_reduce=None)
+        results = []
+        pool.run(lambda: next(units), lambda index, unit, nonce: results.append((index, unit, nonce)), lambda: len(results) >= 6)
+        self.assertEqual(set(index for (index, unit, nonce) in results), set([0, 1]))
+        # Every board got its own units
+        headers = [unit.header for (index, unit, nonce) in results]
+        self.assertEqual(len(set(headers)), len(headers))
+        for (index, unit, nonce) in results:
+            self.assertTrue(unit.check(nonce))
+        self.assertTrue(all(rate > 0 for rate in pool.hashrates()))
+        self.assertEqual(pool.hashrate(), sum(pool.hashrates()))
+
+    def test_job_slots(self):
+        for slots in (1, 2):
+            units = easy_work_units()
+            pool = fpga_pool.FpgaPool([fake_serial(slots=slots)], target_reduce=None)
+            results = []
+            pool.run(lambda: next(units), lambda index, unit, nonce: results.append(unit), lambda: len(results) >= 6)
+            # Only a preloaded job starts without a gap
+            self.assertEqual(0.0 in pool.gaps, slots > 1)
+
+    def test_preempt(self):
+        ports = [fake_serial(hold=True, late=True), fake_serial(hold=True, late=True)]
+        pool = fpga_pool.FpgaPool(ports, target_reduce=None)
+        old_units = easy_work_units(0)
+        new_units = easy_work_units(1)
+        generation = [0]
+
+        def new_block():
+            for port in ports:
+                port.serial.hold = False
+            generation[0] = 1
+            pool.preempt()
+
+        timer = threading.Timer(0.1, new_block)
+        timer.start()
+        results = []
+        pool.run(lambda: next(new_units if generation[0] else old_units), lambda index, unit, nonce: results.append((unit, nonce)),
+                 lambda: len(results) >= 4, lambda unit: unit.generation != generation[0])
+        timer.join()
+        # Both boards report the late nonce of their aborted unit
+        self.assertEqual(sorted([unit.generation for (unit, nonce) in results]), [0, 0, 1, 1])
+        self.assertTrue(all(unit.check(nonce) for (unit, nonce) in results))
+        self.assertEqual(len(pool.restart_latency), 2)
+        self.assertTrue(max(pool.restart_latency) < 1)
+
+    def test_preempt_without_abort(self):
+        port = fake_serial(hold=True, slots=1, can_abort=False)
+        pool = fpga_pool.FpgaPool([port], target_reduce=None)
+        old_units = easy_work_units(0)
+        new_units = easy_work_units(1)
+        generation = [0]
+
+        def new_block():
+            generation[0] = 1
+            pool.preempt()
+            # The stale job ends on its own after the preempt
+            port.serial.hold = False
+            time.sleep(0.1)
+            port.serial.release()
+
+        timer = threading.Timer(0.1, new_block)
+        timer.start()
+        results = []
+        pool.run(lambda: next(new_units if generation[0] else old_units), lambda index, unit, nonce: results.append(unit),
+                 lambda: len(results) >= 2, lambda unit: unit.generation != generation[0])
+        timer.join()
+        self.assertEqual([unit.generation for unit in results], [0, 1])
+        self.assertEqual((port.serial.aborts, pool.restart_latency), (0, []))
+
+    def test_failed_board(self):
+        # The only board rejects its first jobs, it keeps getting new ones and
+        # its port is reopened after REOPEN_FAILURES of them
+        for failures in (1, fpga_pool.REOPEN_FAILURES):
+            port = fake_serial(framed=True, corrupt=serial_comm.FRAME_RETRIES * failures)
+            boards = [port.serial]
+
+            def reopen():
+                port.serial = FakeBoard(framed=True)
+                boards.append(port.serial)
+
+            port.open = reopen
+            units = easy_work_units()
+            pool = fpga_pool.FpgaPool([port], target_reduce=None)
+            results = []
+            pool.run(lambda: next(units), lambda index, unit, nonce: results.append((unit, nonce)), lambda: len(results) >= 2)
+            self.assertTrue(all(unit.check(nonce) for (unit, nonce) in results))
+            self.assertEqual(len(boards), 2 if failures == fpga_pool.REOPEN_FAILURES else 1)
+            self.assertEqual(pool.failures, [0])
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.work = work_queue.WorkGenerator("\x00", ADDRESS, regtest_template, depth=2, poll_interval=60).start()
+
+    def tearDown(self):
+        self.work.stop()
+
+    def test_run(self):
+        blocks = []
+        mining = pipeline.MiningPipeline(self.work, [fake_serial(), fake_serial(framed=True)], 1, blocks.append, target_reduce=None).start()
+        # Until both boards ended jobs, the CPU alone is faster
+        deadline = time.time() + 30
+        while (len(mining.submitted) < 6 or not all(mining.jobs)) and time.time() < deadline:
+            time.sleep(0.01)
+        mining.stop()
+        self.assertTrue(len(blocks) >= 6)
+        self.assertEqual(len(blocks), len(mining.submitted))
+        self.assertTrue(all(block_hash <= block_model.bits2target(0x207fffff) for block_hash in mining.submitted))
+        self.assertTrue(mining.checked >= len(blocks))
+        self.assertTrue(all(mining.jobs))
+
+    def test_slow_submit(self):
+        # The board keeps hashing while a submitblock call hangs
+        release = threading.Event()
+        mining = pipeline.MiningPipeline(self.work, [fake_serial()], submit=lambda block: release.wait(), target_reduce=None).start()
+        deadline = time.time() + 30
+        while mining.jobs[0] < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(mining.submitted, [])
+        self.assertTrue(mining.jobs[0] >= 4)
+        release.set()
+        mining.stop()
+        self.assertTrue(len(mining.submitted) >= 4)
+
+    def test_join(self):
+        # The board fails, join() returns once the blocks found were submitted
+        port = fake_serial()
+        blocks = []
+        mining = pipeline.MiningPipeline(self.work, [port], submit=blocks.append, target_reduce=None).start()
+        deadline = time.time() + 30
+        while mining.jobs[0] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        port.serial.close()
+        mining.join()
+        self.assertTrue(mining.end_reason.startswith("board I/O failed"))
+        self.assertTrue(len(blocks) >= 2)
+        self.assertEqual(len(blocks), len(mining.submitted))
+        self.assertTrue(mining.results.empty() and mining.blocks.empty())
+
+    def test_new_block(self):
+        port = fake_serial(hold=True, late=True)
+        blocks = []
+        mining = pipeline.MiningPipeline(self.work, [port], submit=blocks.append, target_reduce=None).start()
+        deadline = time.time() + 30
+        while len(port.serial.held) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        port.serial.hold = False
+        template = regtest_template()
+        template['previousblockhash'] = "00" * 32
+        self.work.set_template(template)
+        while len(blocks) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        mining.stop()
+        # The late nonce of the aborted job, then blocks on the new tip
+        previous_hashes = [util.hex2bin(block)[4:36] for block in blocks]
+        self.assertEqual(previous_hashes[0], util.hex2bin(regtest_template()['previousblockhash'])[::-1])
+        self.assertEqual(previous_hashes[1:], ["\x00" * 32] * (len(blocks) - 1))
+        self.assertTrue(len(blocks) >= 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import struct
+import numpy
+
+import midstate
+
+'''
+Vectorized nonce search. The 76 byte header prefix is fixed for a whole
+nonce range, so the first chunk is absorbed once with
+midstate.calculateMidstate() and only the second chunk (12 byte tail, nonce
+and padding) plus the second SHA-256 are evaluated here, one numpy uint32
+lane per nonce.
+'''
+
+# Number of nonces hashed per numpy call
+BATCH_SIZE = 1 << 15
+
+_K = numpy.array(midstate.K, dtype=numpy.uint32)
+_IV = [midstate.A0, midstate.B0, midstate.C0, midstate.D0,
+       midstate.E0, midstate.F0, midstate.G0, midstate.H0]
+
+
+def _u32(x):
+    # One element array so that it broadcasts against the nonce lanes
+    # without numpy scalar overflow warnings.
+    return numpy.array([x], dtype=numpy.uint32)
+
+def _rotr(x, n):
+    return (x >> n) | (x << (32 - n))
+
+def _rounds(state, w, rounds=64):
+    """Run the first rounds SHA-256 rounds over 16 message words. Every state
+    and message word is a uint32 array (either one element or one per nonce).
+    Returns the 8 working variables without the final addition.
+    """
+    w = list(w)
+    a, b, c, d, e, f, g, h = state
+    for i in range(rounds):
+        if i >= 16:
+            s0 = _rotr(w[i-15] ^ _rotr(w[i-15], 11), 7) ^ (w[i-15] >> 3)
+            s1 = _rotr(w[i-2] ^ _rotr(w[i-2], 2), 17) ^ (w[i-2] >> 10)
+            w.append(w[i-16] + s0 + w[i-7] + s1)
+        s1 = _rotr(e ^ _rotr(e ^ _rotr(e, 14), 5), 6)
+        ch = g ^ (e & (f ^ g))
+        t1 = h + s1 + ch + (w[i] + _K[i])
+        s0 = _rotr(a ^ _rotr(a ^ _rotr(a, 9), 11), 2)
+        ma = (a & b) | (c & (a | b))
+        h, g, f, e, d, c, b, a = g, f, e, d + t1, c, b, a, t1 + s0 + ma
+    return [a, b, c, d, e, f, g, h]
+
+def _compress(state, w):
+    """Full 64 round compression, returns the 8 words of the new state."""
+    return [x + y for x, y in zip(state, _rounds(state, w))]
+
+def _meets_target(hash_words, target):
+    """Big endian comparison of the 8 hash words (most significant first)
+    against the binary big endian target. Returns a boolean mask."""
+    below = numpy.zeros(hash_words[0].shape, dtype=bool)
+    equal = numpy.ones(hash_words[0].shape, dtype=bool)
+    for word, target_word in zip(hash_words, struct.unpack('>8I', target)):
+        target_word = numpy.uint32(target_word)
+        below |= equal & (word < target_word)
+        equal &= (word == target_word)
+    return below | equal
+
+def _first_hash(midstate_data, tail, nonces):
+    """State words after the second chunk of the header (first SHA-256)."""
+    state = [_u32(x) for x in struct.unpack('>8I', midstate_data)]
+    w = [_u32(x) for x in struct.unpack('>3I', tail)]
+    # The nonce is serialized little endian but SHA-256 reads big endian words
+    w.append(nonces.byteswap())
+    w += [_u32(0x80000000)] + [_u32(0)] * 10 + [_u32(640)]
+    return _compress(state, w)
+
+def _second_hash_message(first):
+    return first + [_u32(0x80000000)] + [_u32(0)] * 6 + [_u32(256)]
+
+def hash_nonces(midstate_data, tail, nonces):
+    """Double SHA-256 of the header for every nonce.
+    :param midstate_data:
+        32 byte midstate of the first 64 header bytes (calculateMidstate).
+    :param tail:
+        Header bytes 64:76 (merkle root tail, time, bits).
+    :param nonces:
+        uint32 numpy array of nonces.
+    Returns the 8 words of the block hash, most significant first, i.e. in
+    the order of the big endian block hash compared against the target.
+    """
+    first = _first_hash(midstate_data, tail, nonces)
+    second = _compress([_u32(x) for x in _IV], _second_hash_message(first))
+    return [word.byteswap() for word in reversed(second)]
+
+def hash_top_words(midstate_data, tail, nonces):
+    """Most significant word of the block hash for every nonce.
+
+    That is the last digest word H7 byteswapped. H7 is the state word h after
+    round 63, which is e after round 60, so rounds 61 to 63 and the message
+    words they use are skipped.
+    """
+    first = _first_hash(midstate_data, tail, nonces)
+    e = _rounds([_u32(x) for x in _IV], _second_hash_message(first), 61)[4]
+    return (e + numpy.uint32(_IV[7])).byteswap()
+
+def hash_nonce(midstate_data, tail, nonce):
+    """Block hash of a single nonce in big endian binary."""
+    words = hash_nonces(midstate_data, tail, numpy.array([nonce], dtype=numpy.uint32))
+    return struct.pack('>8I', *[int(word[0]) for word in words])
+
+def scan_nonces(midstate_data, tail, target, nonce_start=0, count=BATCH_SIZE):
+    """Hash count nonces starting at nonce_start and return the list of
+    nonces whose block hash meets the (binary big endian) target."""
+    nonce_end = min(nonce_start + count, 0x100000000)
+    nonces = numpy.arange(nonce_start, nonce_end, dtype=numpy.uint64).astype(numpy.uint32)
+    # Early reject on the most significant word, only the few survivors get
+    # the full hash and the full target comparison
+    target_top = numpy.uint32(struct.unpack('>I', target[0:4])[0])
+    nonces = nonces[hash_top_words(midstate_data, tail, nonces) <= target_top]
+    if len(nonces) == 0:
+        return []
+    mask = _meets_target(hash_nonces(midstate_data, tail, nonces), target)
+    return [int(n) for n in nonces[mask]]
+
+def search_nonce(midstate_data, tail, target, nonce_start=0, nonce_end=0xffffffff, batch_size=BATCH_SIZE):
+    """Scan [nonce_start, nonce_end] batch by batch and return the first
+    nonce meeting the target, or None if the range is exhausted."""
+    nonce = nonce_start
+    while nonce <= nonce_end:
+        count = min(batch_size, nonce_end - nonce + 1)
+        found = scan_nonces(midstate_data, tail, target, nonce, count)
+        if found:
+            return found[0]
+        nonce += count
+    return None
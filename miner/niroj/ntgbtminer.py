@@ -7,6 +7,7 @@
 #
 
 import urllib2
+import binascii
 import base64
 import json
 import hashlib
@@ -16,6 +17,9 @@ import time
 import midstate
 import util
 import sha256_download
+import cpu_search
+import block_model
+import merkle
 
 # JSON-HTTP RPC Configuration
 # This will be particular to your local ~/.bitcoin/bitcoin.conf
@@ -92,31 +96,16 @@ def int2varinthex(x):
 
 # Convert a binary string to ASCII Hex
 def bin2hex(s):
-    h = ""
-    for c in s:
-        h += "%02x" % ord(c)
-    return h
+    return binascii.hexlify(s)
 
 # Convert an ASCII Hex string to a binary string
 def hex2bin(s):
-    b = ""
-    for i in range(len(s)/2):
-        b += chr(int(s[2*i : 2*i + 2], 16))
-    return b
+    return binascii.unhexlify(s[0:len(s) & ~1])
 
-# Convert a Base58 Bitcoin address to its Hash-160 ASCII Hex
+# Convert a Base58 Bitcoin address to its Hash-160 ASCII Hex, the address is
+# decoded once and cached by block_model.address_hash160
 def bitcoinaddress2hash160(s):
-    table = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
-
-    x = 0
-    s = s[::-1]
-    for i in range(len(s)):
-        x += (58**i)*table.find(s[i])
-
-    # Convert number to ASCII Hex string
-    x = "%050x" % x
-    # Discard 1-byte network byte at beginning and 4-byte checksum at the end
-    return x[2:50-8]
+    return bin2hex(block_model.address_hash160(s))
 
 ################################################################################
 # Transaction Coinbase and Hashing Functions
@@ -183,29 +172,10 @@ def tx_compute_hash(tx):
 #
 # Returns a SHA256 double hash in big endian ASCII Hex
 def tx_compute_merkle_root(tx_hashes):
-    # Convert each hash into a binary string
-    for i in range(len(tx_hashes)):
-        # Reverse the hash from big endian to little endian
-        tx_hashes[i] = hex2bin(tx_hashes[i])[::-1]
-
-    # Iteratively compute the merkle root hash
-    while len(tx_hashes) > 1:
-        # Duplicate last hash if the list is odd
-        if len(tx_hashes) % 2 != 0:
-            tx_hashes.append(tx_hashes[-1][:])
-
-        tx_hashes_new = []
-        for i in range(len(tx_hashes)/2):
-            # Concatenate the next two
-            concat = tx_hashes.pop(0) + tx_hashes.pop(0)
-            # Hash them
-            concat_hash = hashlib.sha256(hashlib.sha256(concat).digest()).digest()
-            # Add them to our working list
-            tx_hashes_new.append(concat_hash)
-        tx_hashes = tx_hashes_new
-
+    # Reverse the hashes from big endian to little endian
+    txids = [hex2bin(tx_hash)[::-1] for tx_hash in tx_hashes]
     # Format the root in big endian ascii hex
-    return bin2hex(tx_hashes[0][::-1])
+    return bin2hex(block_model.merkle_root(txids)[::-1])
 
 ################################################################################
 # Block Preparation Functions
@@ -243,13 +213,8 @@ def reverse_data(block_header, num):
         limit = 16
     else:
         limit = 3
-    header = ""
 
-    for i in range(0 , limit):
-        #print struct.unpack('<L', block_header[i*4:((i+1)*4)])[0]
-        header += struct.pack('>L', struct.unpack('<L', block_header[i*4:((i+1)*4)])[0])
-
-    return header
+    return util.byteswap_words(block_header[0:limit*4])
 
 # Compute the Raw SHA256 Double Hash of a block header
 #
@@ -331,18 +296,23 @@ def block_make_submit(block):
 # Optional Arguments:
 #       timeout:            (False / int) timeout in seconds to give up mining
 #       debugnonce_start:   (False / int) nonce start for testing purposes
+#       merkle_tree:        (None / merkle.MerkleTree) tree of the previous
+#                           template, only the changed paths are rehashed
 #
 # Returns tuple of (solved block, hashes per second) on finding a solution,
 # or (None, hashes per second) on timeout or nonce exhaustion.
-def block_mine(block_template, coinbase_message, extranonce_start, address, timeout=False, debugnonce_start=False):
+def block_mine(block_template, coinbase_message, extranonce_start, address, timeout=False, debugnonce_start=False, merkle_tree=None):
+    # Decode the template once, everything below works on binary data
+    template = block_model.BlockTemplate.from_rpc(block_template, merkle_tree)
+    coinbase_template = template.coinbase_template(hex2bin(coinbase_message), address)
+
     # Add an empty coinbase transaction to the block template
-    coinbase_tx = {}
-    block_template['transactions'].insert(0, coinbase_tx)
+    block_template['transactions'].insert(0, {})
     # Add a nonce initialized to zero to the block template
     block_template['nonce'] = 0
 
     # Compute the target hash
-    target_hash = block_bits2target(block_template['bits'])
+    target_hash = template.target
 
     # Mark our mine start time
     time_start = time.clock()
@@ -350,56 +320,40 @@ def block_mine(block_template, coinbase_message, extranonce_start, address, time
     # Initialize our running average of hashes per second
     hps_list = []
 
-    # Loop through the extranonce
-    extranonce = extranonce_start
-    while extranonce <= 0xffffffff:
-
-        # Update the coinbase transaction with the extra nonce
-        coinbase_script = coinbase_message + int2lehex(extranonce, 4)
-        coinbase_tx['data'] = tx_make_coinbase(coinbase_script, address, block_template['coinbasevalue'])
-        coinbase_tx['hash'] = tx_compute_hash(coinbase_tx['data'])
-
-        # Recompute the merkle root
-        tx_hashes = [tx['hash'] for tx in block_template['transactions']]
-        block_template['merkleroot'] = tx_compute_merkle_root(tx_hashes)
-
-        # Reform the block header
-        block_header = block_form_header(block_template)
+    # Loop through the header times and the extranonce, a new extranonce
+    # updates the coinbase transaction and the merkle root
+    for (extranonce, ntime, block_header) in template.headers(coinbase_template, extranonce_start):
 
         time_stamp = time.clock()
+        hash_count = 0
 
-        # Loop through the nonce
+        # Loop through the nonce in batches
         nonce = 0 if debugnonce_start == False else debugnonce_start
         while nonce <= 0xffffffff:
-            # Update the block header with the new 32-bit nonce
-            block_header = block_header[0:76] + chr(nonce & 0xff) + chr((nonce >> 8) & 0xff) + chr((nonce >> 16) & 0xff) + chr((nonce >> 24) & 0xff)
-            # Recompute the block hash
-            block_hash = block_compute_raw_hash(block_header)
-            print "Algo 1"
-            print "block_header: ", bin2hex(block_header)
-            print "block_hash: ", bin2hex(block_hash)
-
-            # Check if it the block meets the target target hash
-            if block_check_target(block_hash, target_hash):
-                block_template['nonce'] = nonce
-                block_template['hash'] = bin2hex(block_hash)
+            count = min(cpu_search.BATCH_SIZE, 0x100000000 - nonce)
+            found = cpu_search.scan_nonces(block_header, target_hash, nonce, count)
+
+            # Check if a nonce of the batch meets the target hash
+            if found:
+                block_header = block_header[0:76] + struct.pack("<L", found[0])
+                block_model.update_rpc_template(block_template, coinbase_template.coinbase(extranonce), block_header)
                 hps_average = 0 if len(hps_list) == 0 else sum(hps_list)/len(hps_list)
                 return (block_template, hps_average)
 
+            nonce += count
+            hash_count += count
+
             # Lightweight benchmarking of hashes / sec and timeout check
-            if nonce > 0 and nonce % 1000000 == 0:
+            if hash_count >= 1000000:
                 time_elapsed = time.clock() - time_stamp
-                hps_list.append(1000000.0 / time_elapsed)
+                hps_list.append(hash_count / time_elapsed)
                 time_stamp = time.clock()
+                hash_count = 0
 
                 # If our mine time expired, return none
                 if timeout != False and (time_stamp - time_start) > timeout:
                     hps_average = 0 if len(hps_list) == 0 else sum(hps_list)/len(hps_list)
                     return (None, hps_average)
-            break
-            nonce += 1
-        extranonce += 1
-        break
 
     # If we ran out of extra nonces, return none
     hps_average = 0 if len(hps_list) == 0 else sum(hps_list)/len(hps_list)
@@ -457,6 +411,9 @@ def block_mine_with_midstate(block_template, coinbase_message, extranonce_start,
             print "download_hash", download_hash
             # First is trailing 1 bit, then padding
             my_data = midstate.calculateMidstate(block_header[0:64])
+            resumed = sha256_download.FastSHA256.from_midstate(my_data, 64)
+            resumed.update(block_header[64:80])
+            print "resumed_hash", resumed.hexdigest()
             length = 640
             val = [b''.join((
                 block_header[64:80],
@@ -478,10 +435,11 @@ def block_mine_with_midstate(block_template, coinbase_message, extranonce_start,
     return (None, hps_average)
 
 def standalone_miner(coinbase_message, address):
+    merkle_tree = merkle.MerkleTree()
     while True:
         print "Mining new block template..."
         block_temp = rpc_getblocktemplate()
-        mined_block, hps = block_mine(block_temp, coinbase_message, 0, address, timeout=60)
+        mined_block, hps = block_mine(block_temp, coinbase_message, 0, address, timeout=60, merkle_tree=merkle_tree)
         x, y = block_mine_with_midstate(block_temp, coinbase_message, 0, address, timeout=60)
         break
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+import multiprocessing
+import Queue
+import struct
+import time
+import block_model
+import cpu_search
+import ntgbtminer
+
+'''
+Multi-process CPU mining. The nonce space is split into disjoint slices, one
+per worker process. Every worker walks the extranonce space on its own, so
+the (extranonce, nonce) pairs hashed by different workers never overlap and
+no synchronisation is needed apart from a shared stop flag.
+'''
+
+# Nonces hashed between two checks of the stop flag (a few milliseconds)
+WORKER_BATCH_SIZE = 1 << 13
+
+# Seconds the parent waits for a result before checking timeout / stop flag
+POLL_INTERVAL = 0.01
+
+
+def default_workers():
+    return multiprocessing.cpu_count()
+
+# Returns (first, last) nonce of the slice owned by worker out of workers,
+# [nonce_start, nonce_end] is split when given instead of the whole space
+def nonce_range(worker, workers, nonce_start=0, nonce_end=0xffffffff):
+    span = (nonce_end - nonce_start + 1) // workers
+    first = nonce_start + worker * span
+    last = nonce_end if worker == workers - 1 else first + span - 1
+    return (first, last)
+
+# Scan [first, last] of one header, returns the first nonce meeting the target
+# or None when the slice is exhausted or the stop flag is set
+def scan_slice(block_header, target_hash, first, last, stop, hash_counts, worker):
+    nonce = first
+    while nonce <= last:
+        if stop.is_set():
+            return None
+        count = min(WORKER_BATCH_SIZE, last - nonce + 1)
+        found = cpu_search.scan_nonces(block_header, target_hash, nonce, count)
+        hash_counts[worker] += count
+        if found:
+            return found[0]
+        nonce += count
+    return None
+
+def _block_mine_worker(worker, workers, template, coinbase_template, extranonce_start, stop, results, hash_counts):
+    (first, last) = nonce_range(worker, workers)
+
+    for (extranonce, ntime, block_header) in template.headers(coinbase_template, extranonce_start):
+        if stop.is_set():
+            break
+        nonce = scan_slice(block_header, template.target, first, last, stop, hash_counts, worker)
+        if nonce is not None:
+            results.put((extranonce, block_header[0:76], nonce))
+            return
+    results.put(None)
+
+def _double_hash_worker(worker, workers, block_header, target_hash, nonce_start, nonce_end, stop, results, hash_counts):
+    (first, last) = nonce_range(worker, workers, nonce_start, nonce_end)
+    nonce = scan_slice(block_header, target_hash, first, last, stop, hash_counts, worker)
+    results.put(nonce)
+
+# Start one process per worker, wait until a result arrives, every worker gave
+# up, the timeout expires or someone sets the stop flag. Returns
+# (result or None, aggregated hashes per second).
+def _run_workers(target, args, workers, timeout, stop):
+    results = multiprocessing.Queue()
+    hash_counts = multiprocessing.Array('L', workers, lock=False)
+
+    processes = []
+    for worker in range(workers):
+        process = multiprocessing.Process(target=target, args=(worker, workers) + args + (stop, results, hash_counts))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    time_start = time.time()
+    result = None
+    finished = 0
+    while not stop.is_set() and finished < workers:
+        try:
+            result = results.get(timeout=POLL_INTERVAL)
+        except Queue.Empty:
+            if timeout != False and (time.time() - time_start) > timeout:
+                break
+            continue
+        if result is not None:
+            break
+        finished += 1
+
+    # Tell everybody else to stop and collect them
+    stop.set()
+    time_elapsed = time.time() - time_start
+    for process in processes:
+        process.join(1)
+        if process.is_alive():
+            process.terminate()
+
+    hps = 0 if time_elapsed == 0 else sum(hash_counts) / time_elapsed
+    return (result, hps)
+
+# Mine a block with several processes
+#
+# Arguments:
+#       block_template:     (dict) block template
+#       coinbase_message:   (string) binary string for coinbase script
+#       extranonce_start:   (int) extranonce for coinbase script
+#       address:            (string) base58 reward bitcoin address
+#
+# Optional Arguments:
+#       timeout:            (False / int) timeout in seconds to give up mining
+#       workers:            (None / int) number of processes, one per CPU by default
+#       stop:               (None / multiprocessing.Event) set it from outside to
+#                           abandon the template, e.g. when new work is available.
+#                           It is left set on return.
+#
+# Returns the same tuple as ntgbtminer.block_mine: (solved block, hashes per
+# second) on finding a solution, or (None, hashes per second) otherwise.
+def block_mine_parallel(block_template, coinbase_message, extranonce_start, address, timeout=False, workers=None, stop=None):
+    workers = workers or default_workers()
+    stop = multiprocessing.Event() if stop is None else stop
+
+    template = block_model.BlockTemplate.from_rpc(block_template)
+    coinbase_template = template.coinbase_template(ntgbtminer.hex2bin(coinbase_message), address)
+
+    # Add an empty coinbase transaction to the block template
+    block_template['transactions'].insert(0, {})
+    # Add a nonce initialized to zero to the block template
+    block_template['nonce'] = 0
+
+    args = (template, coinbase_template, extranonce_start)
+    (result, hps) = _run_workers(_block_mine_worker, args, workers, timeout, stop)
+    if result is None:
+        return (None, hps)
+
+    # Rebuild the winning header in the parent
+    # The header carries the rolled time and version
+    (extranonce, block_header, nonce) = result
+    block_model.update_rpc_template(block_template, coinbase_template.coinbase(extranonce), block_header + struct.pack("<L", nonce))
+    return (block_template, hps)
+
+# Search the nonce of a fixed 76 byte header with several processes, returns
+# (nonce or None, hashes per second). Only [nonce_start, nonce_end] is
+# searched, e.g. the share of the CPU in hybrid_miner.
+def double_hash_parallel(block_header, target_hash, timeout=False, workers=None, stop=None, nonce_start=0, nonce_end=0xffffffff):
+    workers = workers or default_workers()
+    stop = multiprocessing.Event() if stop is None else stop
+    args = (block_header, target_hash, nonce_start, nonce_end)
+    return _run_workers(_double_hash_worker, args, workers, timeout, stop)
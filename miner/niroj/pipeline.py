@@ -0,0 +1,194 @@
+import multiprocessing
+import Queue
+import threading
+import fpga_pool
+import parallel_miner
+import util
+from config import TARGET_REDUCE
+
+'''
+Standalone mining as concurrent stages joined by queues, so that no stage
+waits for another one to finish its step:
+
+    template polling and    work_queue.WorkGenerator thread, queue of
+    job preparation         prepared units
+    device I/O              one thread running fpga_pool.FpgaPool over
+                            every board, new blocks preempt it
+    CPU hashing (optional)  one thread handing units of their own to the
+                            worker processes of parallel_miner
+    result verification     one thread checking every nonce against the full
+                            target of its unit (WorkUnit.check)
+    block submission        one thread calling submitblock (WorkUnit.submit)
+
+Python 2.7 has no asyncio, each stage is a thread blocking on its input
+queue, which is what an asyncio task awaiting a queue would do, and the CPU
+hashing runs in processes like in an executor so it does not hold the
+interpreter lock the other stages need. A slow submitblock RPC or a slow
+template poll only delays its own stage, the boards keep hashing the units
+already queued.
+'''
+
+# Seconds a stage waits on its input queue before checking for stop()
+POLL_INTERVAL = 0.1
+
+
+class MiningPipeline(object):
+    '''Mines the units of a work_queue.WorkGenerator on boards and the CPU
+
+    Arguments:
+        work:           started work_queue.WorkGenerator
+        ports:          list of serial_comm.MySerial or FramedSerial, one per board
+    Optional Arguments:
+        cpu_workers:    (int) CPU search processes, 0 mines on the boards only
+        submit:         (function) takes the submitblock hex,
+                        util.rpc_submitblock by default
+        target_reduce:  see fpga_pool.FpgaPool
+    '''
+
+    def __init__(self, work, ports, cpu_workers=0, submit=None, target_reduce=TARGET_REDUCE):
+        self.work = work
+        self.pool = fpga_pool.FpgaPool(ports, target_reduce)
+        self.cpu_workers = cpu_workers
+        self.submit = submit or util.rpc_submitblock
+        # (unit, nonce) found by the boards and the CPU, then the ones solving
+        # their unit
+        self.results = Queue.Queue()
+        self.blocks = Queue.Queue()
+        # Jobs ended per board, nonces checked, hashes of the submitted blocks
+        self.jobs = [0] * len(self.pool.devices)
+        self.checked = 0
+        self.submitted = []
+        # Why mining ended, see join()
+        self.end_reason = None
+        self._stop = threading.Event()
+        # Stop flag of the unit the CPU processes search
+        self._cpu_stop = multiprocessing.Event()
+        self._producers = []
+        self._consumers = []
+
+    def start(self):
+        self._stop.clear()
+        self.end_reason = None
+        self.work.add_listener(self._new_block)
+        if self.pool.devices:
+            self._producers.append(self._thread(self._device_stage, "PipelineDevice"))
+        if self.cpu_workers:
+            self._producers.append(self._thread(self._cpu_stage, "PipelineCpu"))
+        self._consumers = [self._thread(self._verify_stage, "PipelineVerify"),
+                           self._thread(self._submit_stage, "PipelineSubmit")]
+        return self
+
+    # Stop the boards and the CPU, then let the results found so far through
+    # verification and submission
+    def stop(self):
+        if not self._consumers:
+            return
+        self._end("stop() was called")
+        self._stop.set()
+        self._cpu_stop.set()
+        for thread in self._producers:
+            thread.join()
+        self.results.put(None)
+        self._consumers[0].join()
+        self.blocks.put(None)
+        self._consumers[1].join()
+        self._producers = []
+        self._consumers = []
+
+    def stopping(self):
+        return self._stop.is_set()
+
+    # Block until every board and CPU stage ended or Ctrl-C, then stop() so
+    # the blocks found so far are still submitted, and print why mining ended
+    def join(self):
+        try:
+            for thread in self._producers:
+                while thread.is_alive():
+                    thread.join(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self._end("interrupted")
+        self.stop()
+        print "Mining ended:", self.end_reason
+
+    # Keeps the first reason mining ended for
+    def _end(self, reason):
+        if self.end_reason is None:
+            self.end_reason = reason
+
+    def _thread(self, target, name, *args):
+        thread = threading.Thread(target=target, args=args, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # WorkGenerator listener: the queued jobs of every board and the unit of
+    # the CPU are stale
+    def _new_block(self):
+        self._cpu_stop.set()
+        self.pool.preempt()
+
+    # Next prepared unit, None once stop() was called
+    def _get_work(self):
+        while not self.stopping():
+            try:
+                return self.work.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                pass
+        return None
+
+    # Nonces of every board and the late ones of aborted jobs go to
+    # verification, the pool statistics are reported at every result
+    def _device_stage(self):
+        pool = self.pool
+
+        def on_result(index, unit, nonce):
+            self.jobs[index] += 1
+            print "Hashes per second( FPGA %d ):" % index, pool.hashrates()[index], " pool:", pool.hashrate()
+            if pool.restart_latency:
+                print "Restart latency( FPGA ):", pool.restart_latency[-1]
+            print "Idle gap between jobs( FPGA ):", pool.idle_gap()
+            if nonce is not None:
+                self.results.put((unit, nonce))
+
+        try:
+            self.pool.run(self._get_work, on_result, self.stopping, self.work.is_stale)
+        except Exception as error:
+            self._end("board I/O failed: %s" % error)
+            raise
+        self._end("no board has a job left")
+        for device in self.pool.devices:
+            device.cancel()
+
+    def _cpu_stage(self):
+        while True:
+            unit = self._get_work()
+            if unit is None:
+                return
+            stop = multiprocessing.Event()
+            self._cpu_stop = stop
+            # A new block may have come in before the flag was replaced
+            if self.work.is_stale(unit) or self.stopping():
+                continue
+            (nonce, hps) = parallel_miner.double_hash_parallel(unit.header, unit.target, workers=self.cpu_workers, stop=stop)
+            if nonce is not None:
+                self.results.put((unit, nonce))
+
+    # Nonces of the boards only meet the reduced target of their job
+    def _verify_stage(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            (unit, nonce) = result
+            self.checked += 1
+            if unit.check(nonce):
+                self.blocks.put(result)
+
+    def _submit_stage(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            (unit, nonce) = block
+            unit.submit(nonce, self.submit)
+            self.submitted.append(unit.block_hash(nonce))
@@ -3,15 +3,117 @@ import midstate
 import hashlib
 import util
 import struct
+import binascii
+import collections
+import block_model
+from config import SERIAL_PROTOCOL, JOB_SLOTS, SERIAL_ABORT, SERIAL_JOB_IDS
 
 DEBUG_STRING = "SERIAL_COMM"
+#Line stopping the running job, the board always answers it with an Abort
+#line, whether a job was running or not. Only sent with config.SERIAL_ABORT,
+#older firmware takes it for a data word.
+ABORT_COMMAND = b'ABORT'
+#Line announcing the id (00 to ff) of the next job, the board appends it to
+#the Nonce: and Fail lines of the job. Only sent with config.SERIAL_JOB_IDS,
+#older firmware takes it for a data word and reports its jobs in order.
+JOB_COMMAND = b'JOB'
+#Jobs remembered to match late results, see get_late_results()
+JOB_HISTORY = 16
+
+#Binary framed protocol, see FramedSerial. A frame is the sync byte, the
+#payload length, the frame type, the payload and a CRC-16/CCITT of length,
+#type and payload.
+FRAME_SYNC = b'\xa5'
+#Host to board: job (id, 12 byte tail, 32 byte midstate, compact target
+#bits) and abort (no payload)
+FRAME_JOB = 0x01
+FRAME_ABORT = 0x02
+#Board to host, all with the same fixed size payload (job id, 4 byte value):
+#job taken, job frame with a bad CRC, nonce (header byte order), no nonce
+#found, job aborted
+FRAME_ACK = 0x81
+FRAME_NAK = 0x82
+FRAME_NONCE = 0x83
+FRAME_FAIL = 0x84
+FRAME_ABORTED = 0x85
+JOB_PAYLOAD = struct.Struct('>B12s32sL')
+RESULT_FRAME = struct.Struct('>cBBB4sH')
+#Times a job frame is sent before giving up on NAKs
+FRAME_RETRIES = 3
+
+#Typed answers of the board, see parse_line(): a job ended with a nonce,
+#without one or by an abort, the echoed target, the echoed data or midstate,
+#anything else
+EVENT_NONCE = 'nonce'
+EVENT_FAIL = 'fail'
+EVENT_ABORT = 'abort'
+EVENT_TARGET = 'target'
+EVENT_ECHO = 'echo'
+EVENT_TEXT = 'text'
+#value is the nonce hex (0 for a failure), the echoed hex or the text
+SerialEvent = collections.namedtuple('SerialEvent', 'kind job_id value')
+
+def frame_crc(data):
+	return binascii.crc_hqx(data, 0xffff)
+
+def build_frame(kind, payload=b''):
+	body = struct.pack('>BB', len(payload), kind) + payload
+	return FRAME_SYNC + body + struct.pack('>H', frame_crc(body))
+
+#SerialEvent of a line of the text protocol, None for an empty line
+def parse_line(line):
+	words = line.split()
+	if not words:
+		return None
+	job_id = None
+	if words[0] == 'Nonce:' and len(words) > 1:
+		if len(words) > 2:
+			job_id = int(words[2], 16)
+		return SerialEvent(EVENT_NONCE, job_id, words[1])
+	if words[0] == 'Fail':
+		if len(words) > 1:
+			job_id = int(words[1], 16)
+		return SerialEvent(EVENT_FAIL, job_id, 0)
+	if words[0] == 'Abort':
+		return SerialEvent(EVENT_ABORT, None, None)
+	if words[1:2] == ['is:'] and len(words) > 2:
+		if words[0] == 'Target':
+			return SerialEvent(EVENT_TARGET, None, words[2])
+		return SerialEvent(EVENT_ECHO, None, words[2])
+	return SerialEvent(EVENT_TEXT, None, line.strip())
+
+#Board object for the configured protocol, "text" (MySerial) or "binary"
+#(FramedSerial)
+def make_serial(serial_port, debug=False, protocol=SERIAL_PROTOCOL, slots=JOB_SLOTS, can_abort=SERIAL_ABORT, job_ids=SERIAL_JOB_IDS):
+	if protocol == "binary":
+		return FramedSerial(serial_port, debug, slots, can_abort)
+	return MySerial(serial_port, debug, slots, can_abort, job_ids)
 
 class MySerial:
 
-	def __init__(self, serial_port="/dev/ttyACM0" , debug='False'):
+	#slots is the number of jobs the board queues, with more than one the next
+	#job is sent while the board still works on the current one. can_abort is
+	#set for firmware that understands ABORT_COMMAND, see abort(), job_ids
+	#for firmware that understands JOB_COMMAND.
+	def __init__(self, serial_port="/dev/ttyACM0" , debug='False', slots=JOB_SLOTS, can_abort=SERIAL_ABORT, job_ids=SERIAL_JOB_IDS):
 		self.serial_port = serial_port
 		self.debug = debug
+		self.slots = slots
+		self.can_abort = can_abort
+		self.job_ids = job_ids
 		self.serial = None
+		self.buffer = ''
+		self.nonce = None
+		#Ids of the jobs on the board, the running one first, and
+		#(job id, nonce) of the ended jobs not read yet
+		self.pending = []
+		self.done = []
+		self.result_id = None
+		self.abort_pending = False
+		#Ring buffer of (job id, context) of the last JOB_HISTORY jobs
+		self.job_id = 0
+		self.jobs = [None] * JOB_HISTORY
+		self.late_results = []
 
 	def open(self):
 		#Debug
@@ -19,45 +121,75 @@ class MySerial:
 			self.serial = "Debug Mode"
 			return
 
-		self.serial = serial.Serial(
-			port=self.serial_port, baudrate=115200, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, 
-			bytesize=serial.EIGHTBITS, timeout=10)
+		try:
+			self.serial = serial.Serial(
+				port=self.serial_port, baudrate=115200, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, 
+				bytesize=serial.EIGHTBITS, timeout=10)
+		except serial.SerialException as error:
+			print "Cannot open " + self.serial_port + ": " + str(error)
+			return
 		print("Connected to: " + self.serial.portstr)
 		self.serial.flushInput()
 		print(self.serial.readline())
 
 	#Data used here are all hex.
 	def write_data( self, data_remaining , midstate_hex , target_hex ):
+		if not self.send_job(data_remaining, midstate_hex, target_hex):
+			return None
+		if self.debug:
+			return
+		self.read_result()
+		print('End')
+		#port.close()
+		return None
+
+	#Sends a job to the board without waiting for its result, see
+	#read_result() and poll_result(). The board queues it behind the jobs it
+	#already has, see free_slots(). Returns False if the board did not echo
+	#the data back. context (e.g. the work unit) is kept with the job id to
+	#check late results, the hex data by default.
+	def send_job( self, data_remaining , midstate_hex , target_hex, context=None ):
 		if self.serial is None:
 			self.open()
 			if self.serial is None:
 				print "Cannot open serial communication with FPGA board"
-				return None
+				return False
 
 		if self.debug:
 			self.data_remaining  = data_remaining 
 			self.midstate_hex  = midstate_hex 
 			self.target_hex  = target_hex 
-			return
+			self.midstate_job = midstate.MidstateJob(util.hex2bin(data_remaining), util.hex2bin(midstate_hex))
+			return True
 		port = self.serial
+		#The Abort answer of the previous job is still on its way
+		if self.abort_pending:
+			self._wait_abort()
+		self._new_job(context if context is not None else (data_remaining, midstate_hex, target_hex))
+		if self.job_ids:
+			port.write(JOB_COMMAND + b' %02x\n' % self.job_id)
 		port.write(data_remaining [0:8].encode())
 		port.write(b'\n')
 		port.write(data_remaining [8:16].encode())
 		port.write(b'\n')
 		port.write(data_remaining [16:24].encode())
 		port.write(b'\n')
-		read1 = port.readline()
+		read1 = self._read_reply()
+		#Output the board still had for the previous job
+		while read1 and not read1.startswith('Data'):
+			read1 = self._read_reply()
 		print "read1", read1
 		words = read1.split()
-		if words[2].lower() != data_remaining:
+		#Nothing came back within the serial timeout
+		if len(words) < 3 or words[2].lower() != data_remaining:
 			print "Something went wrong in communication"
 			print "Original Value: ", data_remaining, "  Received value: ", read1
 			print "Please reset the serail link. Restart the board and try again"
-			return
+			return False
 		else:
 			print read1
-		print(port.readline())
-		print(port.readline())
+		print(self._read_reply())
+		print(self._read_reply())
 		port.write(midstate_hex [0:8].encode())
 		port.write(b'\n')
 		port.write(midstate_hex [8:16].encode())
@@ -74,8 +206,10 @@ class MySerial:
 		port.write(b'\n')
 		port.write(midstate_hex [56:64].encode())
 		port.write(b'\n')
-		print(port.readline())
-		print(port.readline())
+		print(self._read_reply())
+		print(self._read_reply())
+		#The board starts on the job once it has the target
+		self.pending.append(self.job_id)
 		port.write(target_hex [0:8].encode())
 		port.write(b'\n')
 		port.write(target_hex [8:16].encode())
@@ -92,31 +226,203 @@ class MySerial:
 		port.write(b'\n')
 		port.write(target_hex [56:64].encode())
 		port.write(b'\n')
-		line = port.readline()
+		line = self._read_reply()
 		words = line.split()
 		#We are storing the target for future reference if needed for dubuggin by other part of code
 		if words[0] == 'Target':
 			self.target = words[2]
 			print self.target
 		print line
-		print(port.readline())
-		print(port.readline())
-		done = 0
-		while(done == 0):
-			line = port.readline()
-			if  line != b'':
-				print(line)
-				words = line.split()
-				if words[0] == 'Nonce:':
-					self.nonce = words[1]
-					break
-				elif words[0] == 'Fail':
-					self.nonce = 0
-					break
-		print('End')
-		#port.close()
+		print(self._read_reply())
+		print(self._read_reply())
+		self._parse_buffer()
+		return True
+
+	#Closes the port and forgets the jobs on the board, e.g. after it failed
+	#to take several jobs in a row. The next send_job() opens it again.
+	def reopen(self):
+		if self.serial is not None and not self.debug:
+			self.serial.close()
+		self.serial = None
+		self.buffer = ''
+		self.pending = []
+		self.done = []
+		self.abort_pending = False
+
+	#Jobs the board can take before it runs out of slots, ended jobs count
+	#until their result is taken
+	def free_slots(self):
+		return self.slots - len(self.pending) - len(self.done)
+
+	#Takes the next job id and remembers context for it
+	def _new_job(self, context):
+		self.job_id = (self.job_id + 1) & 0xff
+		self.jobs[self.job_id % JOB_HISTORY] = (self.job_id, context)
+
+	#Next line of the board, what is left in the buffer first. Empty after
+	#the serial timeout.
+	def _readline(self):
+		if b'\n' in self.buffer:
+			(line, self.buffer) = self.buffer.split(b'\n', 1)
+			return line
+		line = self.buffer + self.serial.readline()
+		self.buffer = ''
+		return line
+
+	#Next line of the board that is not a job result, the jobs already on the
+	#board may end in between
+	def _read_reply(self):
+		while True:
+			line = self._readline()
+			if not self._parse_line(line):
+				return line
+
+	#Reads and handles the next answer of the board, False after the serial
+	#timeout
+	def _read_answer(self):
+		line = self._readline()
+		if line == b'':
+			return False
+		self._parse_line(line)
+		return True
+
+	#Waits for the Abort answer of the board
+	def _wait_abort(self):
+		while self.abort_pending:
+			if not self._read_answer():
+				print "No answer to the abort from the board"
+				self._aborted()
+
+	#Waits until every job on the board ended, for firmware without ABORT
+	def _wait_jobs(self):
+		while self.pending:
+			self._read_answer()
+
+	#Stops the running and the queued jobs without waiting, they end at the
+	#Abort answer of the board with a None nonce. A nonce reported before the
+	#board saw the command is a late result, see get_late_results(). Does
+	#nothing without can_abort, the jobs then run until they end.
+	def abort(self):
+		if self.debug or not self.can_abort or not self.pending:
+			return
+		self.abort_pending = True
+		self.serial.write(ABORT_COMMAND + b'\n')
+
+	#Replaces the jobs on the board: aborts them, waits only for the Abort
+	#answer (milliseconds) instead of the end of the running job and sends the
+	#new one. Without can_abort it waits for the jobs to end. Results of the
+	#replaced jobs not read yet become late results.
+	def restart( self, data_remaining , midstate_hex , target_hex, context=None ):
+		if self.pending and self.can_abort:
+			self.abort()
+			self._wait_abort()
+		elif self.pending:
+			self._wait_jobs()
+		for (job_id, nonce) in self.done:
+			if nonce:
+				self.late_results.append((job_id, nonce))
+		self.done = []
+		return self.send_job(data_remaining, midstate_hex, target_hex, context)
+
+	#Blocks until the oldest job on the board ends with a nonce, a failure or
+	#an abort, see get_nonce()
+	def read_result(self):
+		#A job may run for long without output, an abort may not
+		while not self.done:
+			if not self._read_answer() and self.abort_pending:
+				print "No answer to the abort from the board"
+				self._aborted()
+		self.next_result()
+
+	#Does not block: consumes what the board sent so far and returns True once
+	#a job ended, see get_nonce() and next_result(). Meant to be called when
+	#select() reports the port readable or has_result() is True.
+	def poll_result(self):
+		if not self.done:
+			port = self.serial
+			self.buffer += port.read(port.in_waiting or 1)
+			self._parse_buffer()
+		return self.next_result()
+
+	#True when a job ended and was read already, e.g. while sending the next
+	#job, select() does not report it
+	def has_result(self):
+		return bool(self.done)
+
+	#Handles the complete answers left in the buffer
+	def _parse_buffer(self):
+		while b'\n' in self.buffer:
+			(line, self.buffer) = self.buffer.split(b'\n', 1)
+			self._parse_line(line)
+
+	#Takes the next ended job already read, returns False if there is none.
+	#get_nonce() and result_id are then those of this job.
+	def next_result(self):
+		if not self.done:
+			return False
+		(self.result_id, self.nonce) = self.done.pop(0)
+		return True
+
+	#Returns True for a result or Abort line
+	def _parse_line(self, line):
+		event = parse_line(line)
+		if event is None or event.kind not in (EVENT_NONCE, EVENT_FAIL, EVENT_ABORT):
+			return False
+		print(line)
+		self._handle(event)
+		return True
+
+	#Job bookkeeping of a Nonce, Fail or Abort answer
+	def _handle(self, event):
+		if event.kind == EVENT_ABORT:
+			self._aborted()
+		#Older firmware sends no job id, its jobs end in order
+		elif event.job_id is not None:
+			self._result(event.value, event.job_id)
+		elif self.pending:
+			self._result(event.value, self.pending[0])
+
+	#Abort answer of the board, every job it had ends without a nonce
+	def _aborted(self):
+		if not self.abort_pending:
+			return
+		self.abort_pending = False
+		self.done.extend([(job_id, None) for job_id in self.pending])
+		self.pending = []
+
+	#Nonce hex (0 for a failure) reported for job_id
+	def _result(self, nonce, job_id):
+		#After an abort the jobs end at the Abort answer
+		if job_id not in self.pending or self.abort_pending:
+			if nonce:
+				self.late_results.append((job_id, nonce))
+			return
+		#The board runs its jobs in order
+		del self.pending[0:self.pending.index(job_id) + 1]
+		self.done.append((job_id, nonce))
+
+	#Context given to send_job() for a job id, None once it left the ring
+	def get_job(self, job_id):
+		entry = self.jobs[job_id % JOB_HISTORY]
+		if entry is not None and entry[0] == job_id:
+			return entry[1]
 		return None
 
+	#Nonces the board reported for older or aborted jobs since the last call,
+	#as a list of (job context or None, nonce hex)
+	def get_late_results(self):
+		results = []
+		while self.late_results:
+			(job_id, nonce) = self.late_results.pop(0)
+			results.append((self.get_job(job_id), nonce))
+		return results
+
+	#Lets select() wait on the board
+	def fileno(self):
+		if self.serial is None:
+			self.open()
+		return self.serial.fileno()
+
 	def get_target(self):
 		return self.target
 
@@ -139,11 +445,7 @@ class MySerial:
 	Debugging serial communication!!!
 	'''
 	def debug_hash(self, nonce):
-		n_nonce = struct.pack("<L", nonce)
-		new_data = util.hex2bin('800000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000280')
-		new_data = n_nonce + new_data
-		second_head = util.hex2bin(self.data_remaining ) + new_data
-		data_temp = midstate.calculateMidstate( second_head, util.hex2bin(self.midstate_hex ), 64 )
+		data_temp = midstate.calculateNonceMidstate( self.midstate_job, nonce )
 		final_hash = hashlib.sha256(data_temp).digest()[::-1]
 		print DEBUG_STRING, util.bin2hex(final_hash)
 		# Check if it the block meets the target target hash
@@ -152,5 +454,114 @@ class MySerial:
 		return (None, nonce)
 
 
+class FramedSerial(MySerial):
+	'''
+	Binary framed protocol, same interface as MySerial. A job is one 54 byte
+	frame (tail, midstate and compact target bits instead of 19 hex lines)
+	checked by its CRC instead of echoed back, answered by an ACK frame. Every
+	answer of the board is a fixed size 10 byte frame, a frame with a bad CRC
+	is skipped up to the next sync byte. It needs board firmware speaking the
+	framed protocol, which is not part of this tree. The firmware the boards
+	run speaks the text protocol of MySerial (config.SERIAL_PROTOCOL "text")
+	without SERIAL_JOB_IDS and SERIAL_ABORT.
+	'''
+
+	def send_job( self, data_remaining , midstate_hex , target_hex, context=None ):
+		if self.debug:
+			return MySerial.send_job(self, data_remaining, midstate_hex, target_hex, context)
+		if self.serial is None:
+			self.open()
+			if self.serial is None:
+				return False
+		#The Abort answer of the previous job is still on its way
+		if self.abort_pending:
+			self._wait_abort()
+		self._new_job(context if context is not None else (data_remaining, midstate_hex, target_hex))
+		bits = block_model.target2bits(util.hex2bin(target_hex))
+		frame = build_frame(FRAME_JOB, JOB_PAYLOAD.pack(self.job_id, util.hex2bin(data_remaining), util.hex2bin(midstate_hex), bits))
+		#The board may end the job right after its ACK
+		self.pending.append(self.job_id)
+		for attempt in range(FRAME_RETRIES):
+			self.serial.write(frame)
+			self.ack = None
+			if not self._read_frames(self._ack):
+				print "No answer to the job frame from the board"
+				break
+			if self.ack == FRAME_ACK:
+				self._parse_buffer()
+				return True
+		else:
+			print "The board rejected the job frame", FRAME_RETRIES, "times"
+		self.pending.remove(self.job_id)
+		return False
+
+	def abort(self):
+		if self.debug or not self.can_abort or not self.pending:
+			return
+		self.abort_pending = True
+		self.serial.write(build_frame(FRAME_ABORT))
+
+	def _parse_buffer(self):
+		for frame in self._frames():
+			self._frame(frame)
+
+	def _read_answer(self):
+		for frame in self._frames():
+			self._frame(frame)
+			return True
+		data = self.serial.read(self.serial.in_waiting or 1)
+		self.buffer += data
+		return bool(data)
+
+	#Complete frames in the buffer as (type, job id, value). Bytes before a
+	#sync byte and frames with a bad length or CRC are dropped.
+	def _frames(self):
+		while True:
+			start = self.buffer.find(FRAME_SYNC)
+			if start < 0:
+				self.buffer = ''
+				return
+			self.buffer = self.buffer[start:]
+			if len(self.buffer) < RESULT_FRAME.size:
+				return
+			frame = self.buffer[0:RESULT_FRAME.size]
+			(sync, length, kind, job_id, value, crc) = RESULT_FRAME.unpack(frame)
+			if length != RESULT_FRAME.size - 5 or crc != frame_crc(frame[1:-2]):
+				self.buffer = self.buffer[1:]
+				continue
+			self.buffer = self.buffer[RESULT_FRAME.size:]
+			yield (kind, job_id, value)
+
+	#Hands frames to handle() until it returns True. Returns False when the
+	#board stays silent for longer than the serial timeout.
+	def _read_frames(self, handle):
+		while True:
+			for frame in self._frames():
+				if handle(frame):
+					return True
+			data = self.serial.read(self.serial.in_waiting or 1)
+			if not data:
+				return False
+			self.buffer += data
 
+	#ACK of the job frame just sent, or NAK (its job id is not trusted). An ACK
+	#of another job id, e.g. a late one of an earlier job, is skipped and the
+	#right one waited for.
+	def _ack(self, frame):
+		if frame[0] == FRAME_NAK or (frame[0] == FRAME_ACK and frame[1] == self.job_id):
+			self.ack = frame[0]
+			return True
+		if frame[0] == FRAME_ACK:
+			print "ACK of job", frame[1], "while waiting for the ACK of job", self.job_id
+			return False
+		self._frame(frame)
+		return False
 
+	def _frame(self, frame):
+		(kind, job_id, value) = frame
+		if kind == FRAME_NONCE:
+			self._handle(SerialEvent(EVENT_NONCE, job_id, util.bin2hex(value)))
+		elif kind == FRAME_FAIL:
+			self._handle(SerialEvent(EVENT_FAIL, job_id, 0))
+		elif kind == FRAME_ABORTED:
+			self._handle(SerialEvent(EVENT_ABORT, job_id, None))
@@ -29,6 +29,7 @@ import collections
 import struct
 import sys
 import util
+import sha256_unrolled
 
 if sys.version > '3':
     long = int
@@ -292,6 +293,67 @@ class SHA256(object):
         return binascii.hexlify(self.digest())
 
 
+class FastSHA256(SHA256):
+    """
+    SHA256 tuned for mining.  Whole blocks are processed by the generated
+    straight-line compression of sha256_unrolled.  The hash can be exported
+    as, and resumed from, an intermediate state so the first block of a
+    header is absorbed once and only the tail is hashed per nonce.  Use
+    SHA256 for tracing, _round() is not called here.
+    """
+
+    @classmethod
+    def _process_block(cls, message, state=SHA256.INITIAL_STATE, round_offset=0):
+        assert len(message) == 64, '_process_block() got %d bytes, expected 64' % len(message)
+
+        return cls.State(*sha256_unrolled.compress(state, struct.unpack('>LLLLLLLLLLLLLLLL', message)))
+
+    @classmethod
+    def from_midstate(cls, state, length):
+        """
+        Returns a hash object resumed from an intermediate state.
+        :param state:
+            32 byte big endian state (as midstate() or
+            midstate.calculateMidstate() return it) or a State tuple.
+        :param length:
+            Number of message bytes absorbed into state, a multiple of 64.
+        """
+
+        assert not length % 64, 'length should be a multiple of 64'
+
+        obj = cls()
+        if isinstance(state, (bytes, bytearray)):
+            state = struct.unpack('>LLLLLLLL', bytes(state))
+        obj.state = cls.State(*state)
+        obj.length = long(length) * 8
+        obj.round_offset = length
+        return obj
+
+    def midstate(self):
+        """
+        Returns the 32 byte intermediate state after the complete blocks
+        absorbed so far.  Data still buffered (less than a block) is not
+        included, see buffered().
+        """
+
+        return struct.pack('>LLLLLLLL', *self.state)
+
+    def buffered(self):
+        """Returns the data not yet absorbed into midstate()."""
+
+        return self.buffer
+
+    def copy(self):
+        """Returns an independent copy of the hash object."""
+
+        obj = self.__class__.__new__(self.__class__)
+        obj.state = self.state
+        obj.length = self.length
+        obj.buffer = self.buffer
+        obj.round_offset = self.round_offset
+        return obj
+
+
 if __name__ == '__main__':
     # Test routine.  Compares our output to that of the stdlib.  We also
     # print some timings, although keep in mind we're not built for speed so
@@ -333,5 +395,17 @@ if __name__ == '__main__':
         elapsed = time.time() - start
         print ('stdlib: %d hashes (%d bytes) in %0.2f secs (%0.2f H/s %d B/s)' % (i+1, consumed, elapsed, float(i+1) / elapsed, float(consumed) / elapsed))
 
-    for a, b, i in zip(mine, stdlib, range(count)):
-        assert a == b, '%r (mine) != %r (stdlib) calculating SHA256(%r) of length %d' % (a, b, message[:i], i)
\ No newline at end of file
+    fast = []
+    try:
+        consumed = 0
+        start = time.time()
+        for i in range(count):
+            fast.append(FastSHA256(message[:i]).hexdigest())
+            consumed += i
+    finally:
+        elapsed = time.time() - start
+        print ('Fast: %d hashes (%d bytes) in %0.2f secs (%0.2f H/s %d B/s)' % (i+1, consumed, elapsed, float(i+1) / elapsed, float(consumed) / elapsed))
+
+    for a, b, c, i in zip(mine, stdlib, fast, range(count)):
+        assert a == b, '%r (mine) != %r (stdlib) calculating SHA256(%r) of length %d' % (a, b, message[:i], i)
+        assert c == b, '%r (fast) != %r (stdlib) calculating SHA256(%r) of length %d' % (c, b, message[:i], i)
\ No newline at end of file
@@ -0,0 +1,141 @@
+'''
+Straight-line SHA-256 compression functions.
+
+The Python source of the 64 rounds is generated at import time with every
+round unrolled, every message word and working variable in its own local
+and the SHA-256 constants folded in, then compiled with exec. There are no
+loops, lists, tuple shuffles or helper calls left in the hot code, which is
+what makes the pure Python loops of midstate.py and sha256_download.py slow.
+
+    compress(state, block)   - one 64 byte block, state and block are tuples
+                               of 8 and 16 32-bit integers
+    nonce_midstate(job, w3)  - second header chunk resumed from round 3 of a
+                               midstate.MidstateJob, w3 is the nonce word
+'''
+
+K = (
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
+    0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174, 0xe49b69c1, 0xefbe4786,
+    0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+    0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85, 0xa2bfe8a1, 0xa81a664b,
+    0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a,
+    0x5b9cca4f, 0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+)
+
+IV = (
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+    0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+)
+
+M = 0xffffffff
+
+
+def _rotr(x, n):
+    # Bits shifted above bit 31 are left for the final mask of the sum
+    return '(%s >> %d | %s << %d)' % (x, n, x, 32 - n)
+
+def _s0(x):
+    return '(%s ^ %s ^ %s >> 3)' % (_rotr(x, 7), _rotr(x, 18), x)
+
+def _s1(x):
+    return '(%s ^ %s ^ %s >> 10)' % (_rotr(x, 17), _rotr(x, 19), x)
+
+def _rotr_const(x, n):
+    return ((x >> n) | (x << (32 - n))) & M
+
+def _s0_const(x):
+    return _rotr_const(x, 7) ^ _rotr_const(x, 18) ^ (x >> 3)
+
+def _s1_const(x):
+    return _rotr_const(x, 17) ^ _rotr_const(x, 19) ^ (x >> 10)
+
+def _schedule(lines, w, last):
+    """Append the message schedule up to word last. w holds, for every known
+    word, either its constant value (int) or the name of its local (str);
+    constant terms are folded and zero terms dropped."""
+    for i in range(len(w), last + 1):
+        const = 0
+        terms = []
+        for (word, func, const_func) in ((w[i-2], _s1, _s1_const), (w[i-7], None, None),
+                                         (w[i-15], _s0, _s0_const), (w[i-16], None, None)):
+            if isinstance(word, str):
+                terms.append(func(word) if func else word)
+            else:
+                const += const_func(word) if const_func else word
+        const &= M
+        if not terms:
+            w.append(const)
+            continue
+        if const:
+            terms.append('0x%08x' % const)
+        lines.append('    w%d = (%s) & 0x%08x' % (i, ' + '.join(terms), M))
+        w.append('w%d' % i)
+
+def _rounds(lines, v, w, first, last):
+    """Append rounds first..last-1. v holds the names of the locals currently
+    holding a..h; instead of shifting the working variables every round the
+    two new values get fresh names."""
+    for i in range(first, last):
+        a, b, c, d, e, f, g, h = v
+        word = w[i] if isinstance(w[i], str) else None
+        const = K[i] if word else (K[i] + w[i]) & M
+        sigma1 = '%s ^ %s ^ %s' % (_rotr(e, 6), _rotr(e, 11), _rotr(e, 25))
+        t1 = '%s + (%s) + (%s ^ (%s & (%s ^ %s))) + 0x%08x' % (h, sigma1, g, e, f, g, const)
+        if word:
+            t1 += ' + ' + word
+        lines.append('    t1 = (%s) & 0x%08x' % (t1, M))
+        lines.append('    e%d = (%s + t1) & 0x%08x' % (i, d, M))
+        lines.append('    a%d = (t1 + (%s ^ %s ^ %s) + ((%s & %s) | (%s & (%s | %s)))) & 0x%08x' % (
+            i, _rotr(a, 2), _rotr(a, 13), _rotr(a, 22), a, b, c, a, b, M))
+        v[:] = ['a%d' % i, a, b, c, 'e%d' % i, e, f, g]
+
+def _finalize(lines, v, initial):
+    lines.append('    return (%s)' % ', '.join(['(%s + %s) & 0x%08x' % (x, y, M) for (x, y) in zip(v, initial)]))
+
+def generate_compress():
+    lines = ['def compress(state, block):']
+    lines.append('    s0, s1, s2, s3, s4, s5, s6, s7 = state')
+    lines.append('    %s = block' % ', '.join(['w%d' % i for i in range(16)]))
+    w = ['w%d' % i for i in range(16)]
+    v = ['s%d' % i for i in range(8)]
+    for i in range(64):
+        _schedule(lines, w, i)
+        _rounds(lines, v, w, i, i + 1)
+    _finalize(lines, v, ['s%d' % i for i in range(8)])
+    return '\n'.join(lines) + '\n'
+
+def generate_nonce_midstate():
+    # Second chunk of an 80 byte header: 3 tail words, the nonce, then the
+    # constant padding and length (640 bits). Rounds 0-2, the nonce free part
+    # of round 3 and of W16..W19 come from the MidstateJob.
+    lines = ['def nonce_midstate(job, w3):']
+    lines.append('    s0, s1, s2, s3, s4, s5, s6, s7 = job.state')
+    lines.append('    r0, r1, r2, r3, r4, r5, r6, r7 = job.rounds3')
+    lines.append('    w16 = job.w16')
+    lines.append('    w17 = job.w17')
+    lines.append('    w18 = (job.w18 + %s) & 0x%08x' % (_s0('w3'), M))
+    lines.append('    w19 = (job.w19 + w3) & 0x%08x' % M)
+    lines.append('    t1 = (job.t1 + w3) & 0x%08x' % M)
+    lines.append('    a3 = (t1 + job.t2) & 0x%08x' % M)
+    lines.append('    e3 = (r3 + t1) & 0x%08x' % M)
+    # W0..W2 are only needed up to W18 and never referenced here
+    w = [None, None, None, 'w3', 0x80000000] + [0] * 10 + [640, 'w16', 'w17', 'w18', 'w19']
+    v = ['a3', 'r0', 'r1', 'r2', 'e3', 'r4', 'r5', 'r6']
+    for i in range(4, 64):
+        _schedule(lines, w, i)
+        _rounds(lines, v, w, i, i + 1)
+    _finalize(lines, v, ['s%d' % i for i in range(8)])
+    return '\n'.join(lines) + '\n'
+
+def _compile(source, name):
+    namespace = {}
+    exec compile(source, '<sha256_unrolled %s>' % name, 'exec') in namespace
+    return namespace[name]
+
+compress = _compile(generate_compress(), 'compress')
+nonce_midstate = _compile(generate_nonce_midstate(), 'nonce_midstate')
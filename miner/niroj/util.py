@@ -1,3 +1,5 @@
+import array
+import binascii
 import random
 import json
 import urllib2
@@ -8,6 +10,7 @@ import struct
 import time
 from config import RPC_USER, RPC_URL, RPC_PASS
 import serial
+import block_model
 
 # JSON-HTTP RPC Configuration
 
@@ -56,31 +59,16 @@ def int2varinthex(x):
 
 # Convert a binary string to ASCII Hex
 def bin2hex(s):
-    h = ""
-    for c in s:
-        h += "%02x" % ord(c)
-    return h
+    return binascii.hexlify(s)
 
 # Convert an ASCII Hex string to a binary string
 def hex2bin(s):
-    b = ""
-    for i in range(len(s)/2):
-        b += chr(int(s[2*i : 2*i + 2], 16))
-    return b
+    return binascii.unhexlify(s[0:len(s) & ~1])
 
-# Convert a Base58 Bitcoin address to its Hash-160 ASCII Hex
+# Convert a Base58 Bitcoin address to its Hash-160 ASCII Hex, the address is
+# decoded once and cached by block_model.address_hash160
 def bitcoinaddress2hash160(s):
-    table = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
-
-    x = 0
-    s = s[::-1]
-    for i in range(len(s)):
-        x += (58**i)*table.find(s[i])
-
-    # Convert number to ASCII Hex string
-    x = "%050x" % x
-    # Discard 1-byte network byte at beginning and 4-byte checksum at the end
-    return x[2:50-8]
+    return bin2hex(block_model.address_hash160(s))
 
 
 def block_check_target(block_hash, target_hash):
@@ -96,16 +84,14 @@ def block_check_target(block_hash, target_hash):
             return False
 
 
+# Byteswap every 32-bit word of a binary string in a single array pass
+def byteswap_words(s):
+    words = array.array('I', s)
+    words.byteswap()
+    return words.tostring()
+
 def convetToLittleEndian(big_endian_str):
     if len(big_endian_str)%4 != 0:
         print "Should be multiple of 4"
         return None
-    count = 0
-    for i in range(len(big_endian_str)/4):
-        val = big_endian_str[count:(count+4)]
-        if i == 0:
-            new_block = val[::-1]
-        else:
-            new_block = new_block + val[::-1]
-        count += 4
-    return new_block
\ No newline at end of file
+    return byteswap_words(big_endian_str)
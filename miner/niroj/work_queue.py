@@ -0,0 +1,213 @@
+import Queue
+import itertools
+import struct
+import threading
+import time
+import block_model
+import cpu_search
+import merkle
+import midstate
+import util
+from config import PREFETCH_DEPTH, TEMPLATE_POLL_INTERVAL
+
+'''
+Prefetched work for the miners. A background producer thread polls
+getblocktemplate and keeps a bounded queue of fully prepared work units
+(header, midstate, 12 byte tail, target, extranonce, header time), so a
+device or CPU search that finishes a unit pulls the next one without any
+preparation latency. When the previous block hash changes the queued units
+are dropped at once and the producer starts over on the new template.
+'''
+
+# Seconds the producer waits on a full queue before checking for a new
+# template or a stop request
+PUT_TIMEOUT = 0.05
+
+
+class WorkUnit(object):
+    '''One ready to run job: the 76 byte header without nonce, its midstate,
+    the 12 byte tail the device hashes with the nonce, the target, header
+    time and what is needed to turn a nonce back into a block'''
+
+    # header_midstate can be passed in when it is already known
+    def __init__(self, template, coinbase_template, extranonce, header, generation,
+                 header_midstate=None):
+        self.template = template
+        self.coinbase_template = coinbase_template
+        self.extranonce = extranonce
+        self.header = header[0:76]
+        self.midstate = header_midstate or midstate.calculateMidstate(header[0:64])
+        self.tail = header[64:76]
+        self.ntime = struct.unpack("<L", header[68:72])[0]
+        self.target = template.target
+        self.previous_hash = template.previous_hash
+        # Template generation of the WorkGenerator, see WorkGenerator.get()
+        self.generation = generation
+        self.created = time.time()
+
+    # Returns the block hash (big endian binary) for a nonce
+    def block_hash(self, nonce):
+        return block_model.double_sha256(self.header + struct.pack("<L", nonce))[::-1]
+
+    def check(self, nonce):
+        return self.block_hash(nonce) <= self.target
+
+    # Returns the submitblock hex of the block solved by nonce
+    def submit_hex(self, nonce):
+        header = self.header + struct.pack("<L", nonce)
+        return self.template.submit_hex(header, self.coinbase_template.coinbase(self.extranonce))
+
+    # Submit the block solved by nonce, submit_block takes the submitblock hex
+    # (util.rpc_submitblock by default)
+    def submit(self, nonce, submit_block=None):
+        print "Solved a block! Block hash:", util.bin2hex(self.block_hash(nonce))
+        return (submit_block or util.rpc_submitblock)(self.submit_hex(nonce))
+
+    # CPU search of [nonce_start, nonce_end], returns the first nonce meeting
+    # the target or None
+    def search(self, nonce_start=0, nonce_end=0xffffffff):
+        return cpu_search.search_nonce(self.header, self.target, nonce_start, nonce_end)
+
+class WorkGenerator(object):
+    '''Background producer of WorkUnits
+
+    Arguments:
+        coinbase_message:   (string) binary coinbase message
+        address:            (string) base58 reward bitcoin address
+    Optional Arguments:
+        get_template:       (function) returns a getblocktemplate result,
+                            util.rpc_getblocktemplate by default
+        depth:              (int) number of prepared units kept ahead
+        poll_interval:      (float) seconds between two template polls
+    '''
+
+    def __init__(self, coinbase_message, address, get_template=None, depth=PREFETCH_DEPTH,
+                 poll_interval=TEMPLATE_POLL_INTERVAL):
+        self.coinbase_message = coinbase_message
+        self.address = address
+        self.get_template = get_template or util.rpc_getblocktemplate
+        self.poll_interval = poll_interval
+        self.queue = Queue.Queue(depth)
+        self.generation = 0
+        self.merkle_tree = merkle.MerkleTree()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._template = None
+        self._coinbase_template = None
+        self._headers = None
+        self._previous_unit = None
+        self._polled = 0
+        self._listeners = []
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="WorkGenerator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    # Stop the producer and the txid threads it used, see
+    # block_model.close_thread_pool()
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        block_model.close_thread_pool()
+
+    # Call callback() whenever a new block makes the running units stale, it
+    # runs on the producer thread and should only wake the miner up
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    # Next prepared unit, units of an older template generation that were
+    # still in the queue are skipped. Raises Queue.Empty after timeout seconds.
+    def get(self, timeout=None):
+        while True:
+            unit = self.queue.get(timeout=timeout)
+            if unit.generation == self.generation:
+                return unit
+
+    # True when unit belongs to an older block than the current template
+    def is_stale(self, unit):
+        return unit.generation != self.generation
+
+    # Drop every queued unit
+    def flush(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                return
+
+    # Switch to a new getblocktemplate result. Queued units are flushed when
+    # the previous block hash changed, otherwise they stay valid and only the
+    # units produced from now on use the new template. The template is built
+    # under the lock as merkle_tree is shared between calls.
+    def set_template(self, rpc_template):
+        with self._lock:
+            template = block_model.BlockTemplate.from_rpc(rpc_template, self.merkle_tree)
+            new_block = self._template is None or template.previous_hash != self._template.previous_hash
+            if new_block:
+                self.generation += 1
+                self.flush()
+            self._template = template
+            self._coinbase_template = template.coinbase_template(self.coinbase_message, self.address)
+            # Header times are rolled before the extranonce
+            self._headers = template.headers(self._coinbase_template)
+        if new_block:
+            for callback in self._listeners:
+                callback()
+        return new_block
+
+    def _poll(self):
+        self._polled = time.time()
+        rpc_template = self.get_template()
+        if rpc_template:
+            self.set_template(rpc_template)
+
+    # Build the next count units of the current template. Units of one
+    # Merkle root and version share their midstate (ntime roll), the
+    # midstates of the new first chunks (version or extranonce roll) are
+    # computed together in one midstate.calculateMidstates() call.
+    def _next_units(self, count):
+        with self._lock:
+            headers = list(itertools.islice(self._headers, count))
+            midstates = {}
+            previous = self._previous_unit
+            if previous is not None and previous.template is self._template:
+                midstates[previous.header[0:64]] = previous.midstate
+            first_chunks = []
+            for (extranonce, ntime, header) in headers:
+                if header[0:64] not in midstates:
+                    midstates[header[0:64]] = None
+                    first_chunks.append(header[0:64])
+            midstates.update(zip(first_chunks, midstate.calculateMidstates(first_chunks)))
+
+            units = [WorkUnit(self._template, self._coinbase_template, extranonce, header, self.generation,
+                              midstates[header[0:64]])
+                     for (extranonce, ntime, header) in headers]
+            if units:
+                self._previous_unit = units[-1]
+            return units
+
+    def _run(self):
+        units = []
+        while not self._stop.is_set():
+            if self._template is None or time.time() - self._polled >= self.poll_interval:
+                self._poll()
+                if self._template is None:
+                    self._stop.wait(self.poll_interval)
+                    continue
+            if not units or units[0].generation != self.generation:
+                units = self._next_units(self.queue.maxsize)
+                if not units:
+                    # Template exhausted, wait for the next one
+                    self._stop.wait(PUT_TIMEOUT)
+                    continue
+            try:
+                self.queue.put(units[0], timeout=PUT_TIMEOUT)
+                units.pop(0)
+            except Queue.Full:
+                pass